@@ -1,50 +1,585 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncio
-import yt_dlp as youtube_dl
 import datetime
 import random
 import time
 from typing import Optional, Dict, List
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import re
+import os
+import sys
+import json
+import enum
+import multiprocessing
+import socket
+import sqlite3
+import struct
+import subprocess
 import aiohttp
 from cachetools import TTLCache
 import functools
+import hashlib
+import threading
+import traceback
+import weakref
+from urllib.parse import urlsplit, parse_qs
+from collections import deque
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # Кэш для результатов поиска (хранится 30 минут)
 search_cache = TTLCache(maxsize=200, ttl=1800)
+# Кэш треков по каноническому ключу "экстрактор:id"
 track_cache = TTLCache(maxsize=100, ttl=3600)
+# Кэш плоских результатов ?search (только id, название и длительность)
+search_results_cache = TTLCache(maxsize=200, ttl=1800)
+
+# Извлечения, которые выполняются прямо сейчас (ключ кэша -> задача)
+pending_extractions: Dict[str, asyncio.Future] = {}
 
 # Глобальный исполнитель для тяжелых операций
 executor = ThreadPoolExecutor(max_workers=20)
 
-intents = discord.Intents.all()
-bot = commands.Bot(command_prefix='?', intents=intents, help_command=None)
+# Режим запуска:
+# 'fast'  — бот сначала подключается к шлюзу, а yt-dlp загружается и прогревается в фоне;
+#           первое извлечение ждет окончания прогрева
+# 'eager' — yt-dlp загружается до подключения к шлюзу
+STARTUP_MODE = 'fast'
+STARTUP_STARTED = time.perf_counter()
+# Длительность этапов запуска в секундах: вход, прогрев yt-dlp, готовность шлюза
+startup_timings: Dict[str, float] = {}
+
+# Реализация цикла событий: 'asyncio' или 'uvloop' (если установлен) — для сравнения производительности
+EVENT_LOOP = 'asyncio'
+
+# Модуль yt_dlp после загрузки и задача его прогрева
+youtube_dl = None
+ytdl_warmup: Optional[asyncio.Future] = None
+
+# Профиль намерений шлюза и кэша участников:
+# 'minimal' — только серверы, голосовые состояния и сообщения; участники кэшируются,
+#             только пока они в голосовом канале, и не запрашиваются при запуске
+# 'full'    — все намерения и полный кэш участников каждого сервера
+INTENTS_PROFILE = 'minimal'
+
+def build_client_options(profile):
+    if profile == 'full':
+        return {'intents': discord.Intents.all()}
+
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.voice_states = True
+    intents.guild_messages = True
+    intents.guild_reactions = True
+    # Нужен для префиксных команд
+    intents.message_content = True
+
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    return {
+        'intents': intents,
+        'member_cache_flags': member_cache_flags,
+        'chunk_guilds_at_startup': False,
+    }
+
+bot = commands.Bot(command_prefix='?', help_command=None, **build_client_options(INTENTS_PROFILE))
+
+# Сколько треков показывать на одной странице ?queue
+QUEUE_PAGE_SIZE = 10
+
+# Очередь треков: общая длительность ведется по мере изменений,
+# а отрисованные страницы ?queue кэшируются до следующего изменения
+class TrackQueue(list):
+    def __init__(self, tracks=()):
+        super().__init__(tracks)
+        self.total_duration = sum(track.get('duration') or 0 for track in self)
+        self.page_cache = {}
+        # Вызывается при каждом изменении очереди
+        self.listener = None
+
+    def touch(self):
+        """Очередь изменилась: кэш страниц больше не действителен"""
+        self.page_cache.clear()
+        if self.listener is not None:
+            self.listener()
+
+    def append(self, track):
+        super().append(track)
+        self.total_duration += track.get('duration') or 0
+        self.touch()
+
+    def extend(self, tracks):
+        tracks = list(tracks)
+        super().extend(tracks)
+        self.total_duration += sum(track.get('duration') or 0 for track in tracks)
+        self.touch()
+
+    def insert(self, index, track):
+        super().insert(index, track)
+        self.total_duration += track.get('duration') or 0
+        self.touch()
+
+    def pop(self, index=-1):
+        track = super().pop(index)
+        self.total_duration -= track.get('duration') or 0
+        self.touch()
+        return track
+
+    def clear(self):
+        super().clear()
+        self.total_duration = 0
+        self.touch()
+
+    def set_duration(self, track, duration):
+        """Длительность стала известна после извлечения; порядок треков не меняется,
+        поэтому слушатель не вызывается"""
+        old = track.get('duration') or 0
+        track['duration'] = duration
+        if any(item is track for item in self):
+            self.total_duration += (duration or 0) - old
+            self.page_cache.clear()
+
+    def shuffle(self):
+        # Перемешивается копия: каждое присваивание в самой очереди пересчитывало бы длительность
+        tracks = list(self)
+        random.shuffle(tracks)
+        super().__setitem__(slice(None), tracks)
+        self.touch()
+
+    # Редкие операции: длительность просто пересчитывается
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._recount()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._recount()
+
+    def _recount(self):
+        self.total_duration = sum(track.get('duration') or 0 for track in self)
+        self.touch()
+
+    def page_count(self):
+        return max(1, (len(self) + QUEUE_PAGE_SIZE - 1) // QUEUE_PAGE_SIZE)
+
+    def render_page(self, page):
+        """Текст страницы очереди; повторные запросы без изменений очереди берутся из кэша"""
+        if page not in self.page_cache:
+            start = (page - 1) * QUEUE_PAGE_SIZE
+            lines = []
+            for i, song in enumerate(self[start:start + QUEUE_PAGE_SIZE], start=start + 1):
+                duration = format_duration(song.get('duration', 0))
+                lines.append(f"**{i}.** [`{duration}`] {song['title']} - {requester_mention(song)}")
+            self.page_cache[page] = "\n".join(lines)
+        return self.page_cache[page]
+
+# Сколько последних треков автовоспроизведение не повторяет
+AUTOPLAY_HISTORY = 50
 
 # Класс для хранения состояния сервера
 class ServerState:
-    def __init__(self):
-        self.queue = []
+    def __init__(self, guild_id: int = 0):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()
         self.current = None
         self.voice_client: Optional[discord.VoiceClient] = None
         self.current_volume = 1.0
-        self.is_paused = False
+        # Режимы воспроизведения; само состояние (пауза, перемотка и т.д.) хранит проигрыватель
         self.is_looping = False
         self.is_radio = False
-        self.is_seeking = False
+        self.autoplay = False
+        # Недавно сыгранные треки: автовоспроизведение их не повторяет
+        self.recent_ids = deque(maxlen=AUTOPLAY_HISTORY)
+        self.recent_set = set()
+        # Следующий трек автовоспроизведения, подготовленный заранее, и трек, для которого он подобран
+        self.autoplay_task = None
+        self.autoplay_seed = None
         self.start_time = 0
         self.last_playing_message = None
         self.nowplaying_updater = None
+        self.last_active = time.monotonic()
+        self.snapshot_task = None
+        self.snapshot_dirty = False
+        # Последняя записанная на диск позиция текущего трека
+        self.saved_position = None
+        self.player = GuildPlayer(self)
+        self.queue.listener = self.player.queue_changed
+
+    def remember_played(self, track_id):
+        if not track_id or track_id in self.recent_set:
+            return
+        if len(self.recent_ids) == self.recent_ids.maxlen:
+            self.recent_set.discard(self.recent_ids[0])
+        self.recent_ids.append(track_id)
+        self.recent_set.add(track_id)
+
+    def is_idle(self):
+        """Ничего не играет и бот не в голосовом канале"""
+        return self.current is None and not (self.voice_client and self.voice_client.is_connected())
 
 # Словарь для хранения состояний каждого сервера
 server_states: Dict[int, ServerState] = {}
 
-# Функция для получения состояния сервера
+# Через сколько секунд бездействия состояние сервера сжимается или удаляется
+STATE_IDLE_TIMEOUT = 900
+
+# Функция для получения состояния сервера (создает его, если это начало воспроизведения)
 def get_server_state(guild_id: int) -> ServerState:
     if guild_id not in server_states:
-        server_states[guild_id] = ServerState()
-    return server_states[guild_id]
+        server_states[guild_id] = ServerState(guild_id)
+        # Очередь, сохраненная до перезапуска, загружается при первом обращении
+        if guild_id in saved_queue_guilds:
+            restore_queue(server_states[guild_id])
+    state = server_states[guild_id]
+    state.last_active = time.monotonic()
+    return state
+
+# Состояние только для чтения: для серверов без воспроизведения ничего не создается
+def peek_server_state(guild_id: int) -> ServerState:
+    state = server_states.get(guild_id)
+    if state is None:
+        if guild_id in saved_queue_guilds:
+            return get_server_state(guild_id)
+        return ServerState(guild_id)
+    state.last_active = time.monotonic()
+    return state
+
+def estimate_track_bytes(track):
+    """Примерный объем трека в памяти (объекты discord.Member не учитываются, они общие с кэшем)"""
+    size = sys.getsizeof(track)
+    for value in track.values():
+        if isinstance(value, (str, int, float)):
+            size += sys.getsizeof(value)
+    return size
+
+def estimate_state_bytes(state):
+    size = sys.getsizeof(state) + sys.getsizeof(state.queue)
+    size += sum(estimate_track_bytes(track) for track in state.queue)
+    if state.current:
+        size += estimate_track_bytes(state.current)
+    return size
+
+def compact_state(state):
+    """Сжатие бездействующего состояния: остаются только данные, нужные для продолжения очереди"""
+    if state.nowplaying_updater:
+        state.nowplaying_updater.cancel()
+        state.nowplaying_updater = None
+    state.last_playing_message = None
+    for track in state.queue:
+        user = track.get('user')
+        if user is not None:
+            track['user_id'] = user.id
+            track['user'] = None
+        # Ссылки на поток все равно устареют, их можно получить заново по странице трека
+        if track.get('webpage_url'):
+            track['url'] = None
+
+# Каталог для локальных данных бота
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kasseta_data')
+QUEUES_DIR = os.path.join(DATA_DIR, 'queues')
+# Изменения очереди записываются на диск не чаще, чем раз в QUEUE_SAVE_DELAY секунд
+QUEUE_SAVE_DELAY = 2
+
+# Серверы, у которых на диске есть снимок очереди, еще не загруженный в память
+saved_queue_guilds = set()
+
+def track_record(track):
+    """Компактная запись трека для хранения на диске"""
+    user = track.get('user')
+    return {
+        'id': track.get('id'),
+        'title': track['title'],
+        'duration': track.get('duration', 0),
+        'webpage_url': track.get('webpage_url'),
+        'user_id': user.id if user is not None else track.get('user_id')
+    }
+
+def track_from_record(record):
+    """Трек из компактной записи: ссылка на поток будет получена перед воспроизведением"""
+    return {
+        'url': None,
+        'title': record['title'],
+        'duration': record.get('duration', 0),
+        'id': record.get('id'),
+        'webpage_url': record['webpage_url'],
+        'user': None,
+        'user_id': record.get('user_id')
+    }
+
+def queue_snapshot(state):
+    records = []
+    if state.current and not state.is_radio and state.current.get('webpage_url'):
+        record = track_record(state.current)
+        record['start_at'] = int(max(0, state.player.position()))
+        records.append(record)
+    records.extend(track_record(track) for track in state.queue if track.get('webpage_url'))
+    return records
+
+def write_queue_snapshot(guild_id, records):
+    path = os.path.join(QUEUES_DIR, f"{guild_id}.json")
+    if not records:
+        for stale in (path, queue_position_path(guild_id)):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
+        return
+
+    os.makedirs(QUEUES_DIR, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+# Позиция текущего трека меняется постоянно, поэтому хранится отдельно от очереди
+# в маленьком файле, и ее обновление не переписывает всю очередь
+def queue_position_path(guild_id):
+    return os.path.join(QUEUES_DIR, f"{guild_id}.position")
+
+def write_queue_position(guild_id, position):
+    os.makedirs(QUEUES_DIR, exist_ok=True)
+    path = queue_position_path(guild_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(position, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def read_queue_position(guild_id):
+    try:
+        with open(queue_position_path(guild_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def mark_queue_dirty(state):
+    """Очередь изменилась: снимок будет записан на диск в фоне"""
+    state.snapshot_dirty = True
+    if state.snapshot_task is None or state.snapshot_task.done():
+        state.snapshot_task = asyncio.create_task(save_queue_snapshot(state))
+
+async def save_queue_snapshot(state):
+    while state.snapshot_dirty:
+        await asyncio.sleep(QUEUE_SAVE_DELAY)
+        state.snapshot_dirty = False
+        try:
+            await run_in_executor(write_queue_snapshot, state.guild_id, queue_snapshot(state))
+        except OSError as e:
+            print(f"Ошибка сохранения очереди: {e}")
+
+def restore_queue(state):
+    saved_queue_guilds.discard(state.guild_id)
+    path = os.path.join(QUEUES_DIR, f"{state.guild_id}.json")
+    try:
+        with open(path, encoding='utf-8') as f:
+            records = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка загрузки очереди: {e}")
+        return
+
+    # Позиция из отдельного файла новее, если относится к тому же первому треку
+    position = read_queue_position(state.guild_id)
+    if records and isinstance(position, dict) and position.get('webpage_url') == records[0].get('webpage_url'):
+        records[0]['start_at'] = position.get('start_at', 0)
+
+    for record in records:
+        track = track_from_record(record)
+        if record.get('start_at'):
+            track['start_at'] = record['start_at']
+        state.queue.append(track)
+
+def list_saved_queues():
+    try:
+        names = os.listdir(QUEUES_DIR)
+    except FileNotFoundError:
+        return set()
+    return {int(name[:-len('.json')]) for name in names if name.endswith('.json') and name[:-len('.json')].isdigit()}
+
+SAVED_PLAYLISTS_DIR = os.path.join(DATA_DIR, 'saved_playlists')
+# Ограничения сохраненных плейлистов сервера
+SAVED_PLAYLISTS_MAX = 25
+SAVED_PLAYLIST_MAX_TRACKS = 5000
+SAVED_PLAYLIST_NAME_MAX = 32
+saved_playlists_lock = threading.Lock()
+
+# Сохраненные плейлисты сервера: один файл на сервер,
+# {название в нижнем регистре: {name, author_id, saved, duration, tracks: [компактные записи]}}
+def read_saved_playlists(guild_id):
+    try:
+        with open(os.path.join(SAVED_PLAYLISTS_DIR, f"{guild_id}.json"), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def write_saved_playlists(guild_id, playlists):
+    os.makedirs(SAVED_PLAYLISTS_DIR, exist_ok=True)
+    path = os.path.join(SAVED_PLAYLISTS_DIR, f"{guild_id}.json")
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(playlists, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def save_playlist_sync(guild_id, name, author_id, records):
+    """Сохранение плейлиста; False, если у сервера уже слишком много плейлистов"""
+    with saved_playlists_lock:
+        playlists = read_saved_playlists(guild_id)
+        key = name.lower()
+        if key not in playlists and len(playlists) >= SAVED_PLAYLISTS_MAX:
+            return False
+        playlists[key] = {
+            'name': name,
+            'author_id': author_id,
+            'saved': int(time.time()),
+            'duration': sum(record.get('duration') or 0 for record in records),
+            'tracks': records
+        }
+        write_saved_playlists(guild_id, playlists)
+        return True
+
+@tasks.loop(seconds=30)
+async def snapshot_playing_queues():
+    """Периодически обновляем позицию текущего трека; сама очередь при этом не переписывается"""
+    for state in list(server_states.values()):
+        if not state.current or state.is_radio or not state.current.get('webpage_url'):
+            continue
+        position = {
+            'webpage_url': state.current['webpage_url'],
+            'start_at': int(max(0, state.player.position()))
+        }
+        if position == state.saved_position:
+            continue
+        state.saved_position = position
+        try:
+            await run_in_executor(write_queue_position, state.guild_id, position)
+        except OSError as e:
+            print(f"Ошибка сохранения позиции: {e}")
+
+@tasks.loop(seconds=60)
+async def evict_idle_states():
+    now = time.monotonic()
+    for guild_id, state in list(server_states.items()):
+        if not state.is_idle() or now - state.last_active < STATE_IDLE_TIMEOUT:
+            continue
+        if state.queue:
+            compact_state(state)
+        else:
+            del server_states[guild_id]
+
+# Сколько секунд держать голосовое соединение после остановки или конца очереди
+VOICE_IDLE_TIMEOUT = 300
+
+# Менеджер голосовых соединений: подключение, перемещение, "теплое" ожидание и ремонт
+class VoiceManager:
+    def __init__(self):
+        self.idle_timers: Dict[int, asyncio.Task] = {}
+        self.latencies = {'connect': deque(maxlen=100), 'move': deque(maxlen=100)}
+        self.counters = {'connect': 0, 'move': 0, 'reuse': 0, 'repair': 0, 'idle_disconnect': 0, 'failed': 0}
+
+    def is_alive(self, guild, voice_client):
+        """Проверка, что соединение не "полумертвое": клиент подключен и Discord видит бота в канале"""
+        if voice_client is None or not voice_client.is_connected():
+            return False
+        if guild.voice_client is not voice_client:
+            return False
+        me = guild.me
+        return bool(me and me.voice and me.voice.channel)
+
+    async def ensure_connected(self, ctx):
+        """Подключение к каналу автора команды с переиспользованием теплого соединения"""
+        guild = ctx.guild
+        state = get_server_state(guild.id)
+        channel = ctx.author.voice.channel
+        self.cancel_idle(guild.id)
+
+        voice_client = state.voice_client or guild.voice_client
+        if voice_client is not None and not self.is_alive(guild, voice_client):
+            self.counters['repair'] += 1
+            try:
+                await voice_client.disconnect(force=True)
+            except Exception as e:
+                print(f"Ошибка закрытия соединения: {e}")
+            voice_client = None
+
+        started = time.perf_counter()
+        try:
+            if voice_client is None:
+                voice_client = await channel.connect()
+                self._record('connect', started)
+            elif voice_client.channel != channel:
+                await voice_client.move_to(channel)
+                self._record('move', started)
+            else:
+                self.counters['reuse'] += 1
+        except Exception:
+            self.counters['failed'] += 1
+            raise
+
+        state.voice_client = voice_client
+        return voice_client
+
+    def _record(self, kind, started):
+        self.counters[kind] += 1
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    def release(self, guild_id):
+        """Очередь опустела: соединение остается теплым VOICE_IDLE_TIMEOUT секунд"""
+        self.cancel_idle(guild_id)
+        self.idle_timers[guild_id] = asyncio.create_task(self._idle_disconnect(guild_id))
+
+    def cancel_idle(self, guild_id):
+        timer = self.idle_timers.pop(guild_id, None)
+        if timer:
+            timer.cancel()
+
+    async def _idle_disconnect(self, guild_id):
+        await asyncio.sleep(VOICE_IDLE_TIMEOUT)
+        self.idle_timers.pop(guild_id, None)
+        state = server_states.get(guild_id)
+        if not state or not state.voice_client:
+            return
+        if state.voice_client.is_playing() or state.voice_client.is_paused():
+            return
+        self.counters['idle_disconnect'] += 1
+        await self.disconnect(guild_id)
+
+    async def disconnect(self, guild_id):
+        self.cancel_idle(guild_id)
+        state = server_states.get(guild_id)
+        if not state or not state.voice_client:
+            return
+        voice_client, state.voice_client = state.voice_client, None
+        voice_client.stop()
+        if voice_client.is_connected():
+            await voice_client.disconnect()
+
+    def report(self):
+        lines = []
+        for kind, samples in self.latencies.items():
+            if samples:
+                ordered = sorted(samples)
+                avg = sum(ordered) / len(ordered)
+                p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+                lines.append(f"**{kind}**: {len(ordered)} шт., среднее {avg * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms")
+            else:
+                lines.append(f"**{kind}**: нет данных")
+        lines.append(" | ".join(f"{name}: {count}" for name, count in self.counters.items()))
+        lines.append(f"Теплых соединений в ожидании: {len(self.idle_timers)}")
+        return "\n".join(lines)
+
+voice_manager = VoiceManager()
 
 # Оптимизированные настройки yt-dlp для быстрого извлечения
 ytdl_format_options = {
@@ -76,7 +611,828 @@ ffmpeg_options = {
     'options': '-vn -filter:a "volume=0.99"'
 }
 
-YTDL = youtube_dl.YoutubeDL(ytdl_format_options)
+# Битрейт кодировщика Opus по умолчанию в discord.py (кбит/с); выше него не кодируем —
+# исходный звук с YouTube лучше от этого не станет
+OPUS_DEFAULT_BITRATE = 128
+# Сложность кодировщика Opus (0-10) по битрейту канала: на низком битрейте
+# максимальная сложность почти не улучшает звук, а процессор тратит
+OPUS_COMPLEXITY_BY_BITRATE = ((64, 5), (96, 8))
+OPUS_MAX_COMPLEXITY = 10
+OPUS_SET_COMPLEXITY_CTL = 4010
+
+# Текущие настройки кодировщика по серверам: (битрейт, сложность)
+encoder_settings: Dict[int, tuple] = {}
+
+def channel_bitrate(channel):
+    """Битрейт голосового канала в кбит/с: выше него Discord все равно не передаст"""
+    bitrate = getattr(channel, 'bitrate', None)
+    if not bitrate:
+        return OPUS_DEFAULT_BITRATE
+    return min(OPUS_DEFAULT_BITRATE, max(16, bitrate // 1000))
+
+def opus_complexity(kbps):
+    for limit, complexity in OPUS_COMPLEXITY_BY_BITRATE:
+        if kbps <= limit:
+            return complexity
+    return OPUS_MAX_COMPLEXITY
+
+def configure_encoder(voice_client, guild_id, channel=None):
+    """Настройка кодировщика под битрейт канала; вызывается при запуске трека и переезде в другой канал"""
+    kbps = channel_bitrate(channel or voice_client.channel)
+    complexity = opus_complexity(kbps)
+
+    # Звук с аудиоузла уже закодирован: настройки уходят узлу
+    source = underlying_source(voice_client.source)
+    if isinstance(source, NodeAudioSource):
+        source.set_encoder(kbps, complexity)
+        encoder_settings[guild_id] = (kbps, complexity)
+        return
+
+    encoder = getattr(voice_client, 'encoder', None)
+    if not encoder:
+        return
+    try:
+        encoder.set_bitrate(kbps)
+        discord.opus._lib.opus_encoder_ctl(encoder._state, OPUS_SET_COMPLEXITY_CTL, complexity)
+    except Exception as e:
+        print(f"Ошибка настройки кодировщика: {e}")
+        return
+    encoder_settings[guild_id] = (kbps, complexity)
+
+def encoder_report():
+    playing = [
+        encoder_settings[guild_id] for guild_id, state in server_states.items()
+        if guild_id in encoder_settings and state.voice_client and state.voice_client.is_playing()
+    ]
+    if not playing:
+        return "Кодировщики: ничего не играет"
+    total = sum(kbps for kbps, _ in playing)
+    default = OPUS_DEFAULT_BITRATE * len(playing)
+    average_complexity = sum(complexity for _, complexity in playing) / len(playing)
+    return (
+        f"Кодировщики: {len(playing)} потоков, {total} кбит/с вместо {default} "
+        f"(экономия {(default - total) / default * 100:.0f}%), средняя сложность {average_complexity:.1f} из {OPUS_MAX_COMPLEXITY}"
+    )
+
+def load_ytdl():
+    """Импорт и прогрев yt-dlp (выполняется в потоке исполнителя)"""
+    global youtube_dl
+    started = time.perf_counter()
+    import yt_dlp
+    # Первый YoutubeDL проверяет опции и подгружает экстракторы
+    with yt_dlp.YoutubeDL(ytdl_format_options):
+        pass
+    youtube_dl = yt_dlp
+    startup_timings['yt-dlp'] = time.perf_counter() - started
+
+def start_ytdl_warmup():
+    global ytdl_warmup
+    if ytdl_warmup is None:
+        ytdl_warmup = asyncio.get_event_loop().run_in_executor(executor, load_ytdl)
+    return ytdl_warmup
+
+async def ensure_ytdl():
+    """Ожидание готовности yt-dlp перед первым извлечением"""
+    if youtube_dl is None:
+        await asyncio.shield(start_ytdl_warmup())
+
+# Ограничения на число одновременных процессов ffmpeg
+FFMPEG_MAX_PROCESSES = 40
+FFMPEG_MAX_PER_GUILD = 3
+# Процесс моложе этого не считается осиротевшим: источник мог еще не успеть запуститься
+FFMPEG_ORPHAN_GRACE = 15
+
+def process_usage(pid):
+    """Процессорное время (с) и RSS (байты) процесса: через psutil или /proc"""
+    try:
+        if psutil is not None:
+            proc = psutil.Process(pid)
+            cpu = proc.cpu_times()
+            return cpu.user + cpu.system, proc.memory_info().rss
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open(f'/proc/{pid}/statm') as f:
+            rss_pages = int(f.read().split()[1])
+        ticks = os.sysconf('SC_CLK_TCK')
+        return (int(fields[11]) + int(fields[12])) / ticks, rss_pages * os.sysconf('SC_PAGE_SIZE')
+    except Exception:
+        return None
+
+def underlying_source(source):
+    """Исходный источник под оберткой вроде PCMVolumeTransformer"""
+    while hasattr(source, 'original'):
+        source = source.original
+    return source
+
+def playing_sources(source):
+    """Источники, которые сейчас звучат: у микшера это все его декодеры"""
+    if isinstance(source, MixerSource):
+        return [underlying_source(deck.source) for deck in source.decks()]
+    return [underlying_source(source)]
+
+# Реестр всех запущенных процессов ffmpeg по серверам
+class FFmpegRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.counters = {'spawned': 0, 'reaped': 0, 'rejected': 0}
+
+    def register(self, process, guild_id, source):
+        with self.lock:
+            self.counters['spawned'] += 1
+            self.processes[process.pid] = {
+                'process': process,
+                'guild_id': guild_id,
+                'started': time.time(),
+                'source': weakref.ref(source),
+                # Процесс уже остановлен, но еще не дождались его завершения
+                'killed': False
+            }
+
+    def unregister(self, process):
+        if process is None or not hasattr(process, 'pid'):
+            return
+        with self.lock:
+            self.processes.pop(process.pid, None)
+
+    def over_limit(self, guild_id):
+        """Остановленные процессы в лимитах не учитываются"""
+        with self.lock:
+            alive = [entry for entry in self.processes.values() if not entry['killed']]
+        guild_count = sum(1 for entry in alive if entry['guild_id'] == guild_id)
+        return guild_count >= FFMPEG_MAX_PER_GUILD or len(alive) >= FFMPEG_MAX_PROCESSES
+
+    def check_limits(self, guild_id):
+        """Проверка лимитов перед запуском; при превышении сначала убираем сирот.
+        Вызывается в цикле событий, поэтому процессы только получают сигнал,
+        а их завершения дождется периодическая очистка"""
+        if self.over_limit(guild_id):
+            self.reap(grace=0, wait=False)
+        if self.over_limit(guild_id):
+            self.counters['rejected'] += 1
+            raise discord.ClientException("Превышен лимит процессов ffmpeg")
+
+    def is_attached(self, entry):
+        """Процесс принадлежит источнику, который сейчас играет на своем сервере"""
+        source = entry['source']()
+        state = server_states.get(entry['guild_id'])
+        if source is None or state is None or state.voice_client is None:
+            return False
+        return any(playing is source for playing in playing_sources(state.voice_client.source))
+
+    def reap(self, grace=FFMPEG_ORPHAN_GRACE, wait=True):
+        """Удаление завершившихся процессов и остановка тех, что не привязаны к активному источнику;
+        без wait процессы только получают сигнал и остаются в реестре до следующей очистки"""
+        now = time.time()
+        with self.lock:
+            entries = list(self.processes.items())
+        for pid, entry in entries:
+            process = entry['process']
+            if process.poll() is not None:
+                self.unregister(process)
+                continue
+            if entry['killed']:
+                if wait:
+                    self._wait(pid, process)
+                continue
+            if now - entry['started'] < grace or self.is_attached(entry):
+                continue
+            try:
+                process.kill()
+            except Exception as e:
+                print(f"Ошибка остановки ffmpeg {pid}: {e}")
+            entry['killed'] = True
+            self.counters['reaped'] += 1
+            if wait:
+                self._wait(pid, process)
+
+    def _wait(self, pid, process):
+        try:
+            process.wait(timeout=1)
+        except Exception as e:
+            print(f"Ошибка остановки ffmpeg {pid}: {e}")
+        self.unregister(process)
+
+    def report(self):
+        now = time.time()
+        with self.lock:
+            entries = list(self.processes.items())
+        lines = [
+            f"Процессов: {len(entries)} / {FFMPEG_MAX_PROCESSES} (на сервер: {FFMPEG_MAX_PER_GUILD}) | "
+            + " | ".join(f"{name}: {count}" for name, count in self.counters.items())
+        ]
+        for pid, entry in entries[:20]:
+            age = now - entry['started']
+            usage = process_usage(pid)
+            if usage:
+                cpu_seconds, rss = usage
+                stats = f"CPU {cpu_seconds:.1f}с ({cpu_seconds / max(age, 1) * 100:.0f}%), RSS {rss / 1048576:.1f} МБ"
+            else:
+                stats = "нет данных"
+            attached = "играет" if self.is_attached(entry) else "не привязан"
+            lines.append(f"`{pid}` сервер {entry['guild_id']}: {format_duration(age)}, {stats}, {attached}")
+        return "\n".join(lines)
+
+ffmpeg_registry = FFmpegRegistry()
+
+class TrackedFFmpegPCMAudio(discord.FFmpegPCMAudio):
+    """FFmpegPCMAudio, процесс которого учитывается в реестре"""
+
+    def __init__(self, source, *, guild_id, **kwargs):
+        self.guild_id = guild_id
+        # HTTP-ответ из общего пула, который подается ffmpeg через stdin
+        self.stream = None if isinstance(source, str) else source
+        super().__init__(source, **kwargs)
+
+    def _spawn_process(self, args, **subprocess_kwargs):
+        ffmpeg_registry.check_limits(self.guild_id)
+        process = super()._spawn_process(args, **subprocess_kwargs)
+        ffmpeg_registry.register(process, self.guild_id, self)
+        return process
+
+    def cleanup(self):
+        process = getattr(self, '_process', None)
+        super().cleanup()
+        ffmpeg_registry.unregister(process)
+        if self.stream is not None:
+            self.stream.close()
+
+@tasks.loop(seconds=30)
+async def reap_ffmpeg_processes():
+    await run_in_executor(ffmpeg_registry.reap)
+
+# Аудиоузлы — отдельные процессы (audio_node.py), которые сами запускают ffmpeg и кодируют звук в Opus,
+# например [('127.0.0.1', 8765), ('127.0.0.1', 8766)]. Пустой список — звук обрабатывается в процессе бота
+AUDIO_NODES = []
+# Сколько секунд не использовать узел после ошибки соединения
+AUDIO_NODE_RETRY = 30
+AUDIO_NODE_CONNECT_TIMEOUT = 3
+# Узел молчит дольше этого — считаем, что он завис
+AUDIO_NODE_READ_TIMEOUT = 10
+AUDIO_NODE_HEADER = struct.Struct('!cI')
+
+class AudioNodeError(ConnectionError):
+    """Соединение с аудиоузлом потеряно: трек можно продолжить на другом узле или локально"""
+
+class AudioNode:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.streams = 0
+        self.failed_until = 0
+        self.counters = {'streams': 0, 'failures': 0}
+
+    @property
+    def name(self):
+        return f"{self.host}:{self.port}"
+
+    def is_available(self):
+        return time.monotonic() >= self.failed_until
+
+    def connect(self, request):
+        sock = socket.create_connection((self.host, self.port), timeout=AUDIO_NODE_CONNECT_TIMEOUT)
+        sock.settimeout(AUDIO_NODE_READ_TIMEOUT)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        return sock
+
+    def stats(self):
+        """Число потоков и pid узла по его собственным данным"""
+        with self.connect({'op': 'stats'}) as sock:
+            reader = sock.makefile('rb')
+            kind, length = AUDIO_NODE_HEADER.unpack(reader.read(AUDIO_NODE_HEADER.size))
+            return json.loads(reader.read(length))
+
+# Пул аудиоузлов: новый поток идет на доступный узел с наименьшим числом потоков
+class AudioNodePool:
+    def __init__(self, addresses):
+        self.nodes = [AudioNode(host, port) for host, port in addresses]
+
+    def pick(self):
+        available = [node for node in self.nodes if node.is_available()]
+        return min(available, key=lambda node: node.streams, default=None)
+
+    def mark_failed(self, node, error):
+        node.counters['failures'] += 1
+        node.failed_until = time.monotonic() + AUDIO_NODE_RETRY
+        print(f"Аудиоузел {node.name} недоступен: {error}")
+
+    def report(self):
+        if not self.nodes:
+            return "Аудиоузлы не настроены, звук обрабатывается в процессе бота"
+        lines = []
+        for node in self.nodes:
+            try:
+                stats = node.stats()
+                usage = process_usage(stats['pid'])
+                details = f"потоков по данным узла: {stats['streams']}"
+                if usage:
+                    details += f", CPU {usage[0]:.0f}с, RSS {usage[1] / 1048576:.1f} МБ"
+            except (OSError, ValueError, struct.error) as e:
+                details = f"нет связи ({e})"
+            status = "доступен" if node.is_available() else f"пропускается еще {node.failed_until - time.monotonic():.0f}с"
+            lines.append(
+                f"**{node.name}**: {status}, потоков: {node.streams}, {details} | "
+                + " | ".join(f"{name}: {count}" for name, count in node.counters.items())
+            )
+        return "\n".join(lines)
+
+node_pool = AudioNodePool(AUDIO_NODES)
+
+class NodeAudioSource(discord.AudioSource):
+    """Готовые кадры Opus от аудиоузла; громкость и настройки кодировщика передаются узлу"""
+
+    def __init__(self, node, url, *, position=0, volume=1.0, bitrate=128, complexity=10, before_options='', options=''):
+        self.node = node
+        self.position = position
+        self._volume = volume
+        self._current_error = None
+        self.sock = None
+        self.sock = node.connect({
+            'op': 'play', 'url': url, 'position': position, 'volume': volume,
+            'bitrate': bitrate, 'complexity': complexity,
+            'before_options': before_options, 'options': options
+        })
+        self.reader = self.sock.makefile('rb')
+        node.streams += 1
+        node.counters['streams'] += 1
+
+    def is_opus(self):
+        return True
+
+    def send(self, command):
+        try:
+            self.sock.sendall(json.dumps(command).encode() + b'\n')
+        except OSError:
+            pass
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self.send({'op': 'volume', 'value': value})
+
+    def set_encoder(self, bitrate, complexity):
+        self.send({'op': 'encoder', 'bitrate': bitrate, 'complexity': complexity})
+
+    def _read_packet(self):
+        try:
+            header = self.reader.read(AUDIO_NODE_HEADER.size)
+            if len(header) < AUDIO_NODE_HEADER.size:
+                raise AudioNodeError("узел закрыл соединение")
+            kind, length = AUDIO_NODE_HEADER.unpack(header)
+            payload = self.reader.read(length)
+            if len(payload) < length:
+                raise AudioNodeError("узел закрыл соединение")
+            return kind, payload
+        except OSError as e:
+            raise AudioNodeError(str(e))
+
+    def read(self):
+        """Вызывается аудиопотоком discord.py каждые 20 мс"""
+        while True:
+            try:
+                kind, payload = self._read_packet()
+            except AudioNodeError as e:
+                node_pool.mark_failed(self.node, e)
+                raise
+            if kind == b'a':
+                return payload
+            event = json.loads(payload)
+            if event['event'] == 'position':
+                self.position = event['seconds']
+            elif event['event'] == 'end':
+                return b''
+            elif event['event'] == 'error':
+                self._current_error = Exception(event['message'])
+                return b''
+
+    def cleanup(self):
+        if self.sock is None:
+            return
+        self.send({'op': 'stop'})
+        self.sock.close()
+        self.sock = None
+        self.node.streams -= 1
+
+# Микшер: один источник на всю сессию, треки сменяются внутри него без перезапуска voice_client.play
+MIXER_ENABLED = True
+# Длительность кроссфейда (с); 0 — стык без паузы. Кроссфейду нужен numpy
+CROSSFADE_SECONDS = 0
+# Сколько секунд микшер выдает тишину в ожидании следующего трека, прежде чем отпустить голосовой клиент
+MIXER_IDLE_SECONDS = 5
+# За сколько секунд до конца трека запускать декодер следующего
+MIXER_PRELOAD_SECONDS = 15
+FRAME_SIZE = discord.opus.Encoder.FRAME_SIZE
+FRAME_SECONDS = discord.opus.Encoder.FRAME_LENGTH / 1000
+SILENCE_FRAME = b'\0' * FRAME_SIZE
+
+def crossfade_seconds():
+    return CROSSFADE_SECONDS if numpy is not None else 0
+
+def mix_frames(outgoing, incoming, start, end):
+    """Кроссфейд одного кадра: доля входящего трека плавно растет от start до end"""
+    a = numpy.frombuffer(outgoing, dtype=numpy.int16).reshape(-1, 2).astype(numpy.float32)
+    b = numpy.frombuffer(incoming, dtype=numpy.int16).reshape(-1, 2).astype(numpy.float32)
+    ramp = numpy.linspace(start, end, len(a), endpoint=False, dtype=numpy.float32)[:, None]
+    mixed = a * (1 - ramp) + b * ramp
+    return numpy.clip(mixed, -32768, 32767).astype(numpy.int16).tobytes()
+
+class MixerDeck:
+    """Декодер одного трека в микшере"""
+
+    def __init__(self, source, generation, track, position=0):
+        self.source = source
+        self.generation = generation
+        self.track = track
+        self.duration = (track or {}).get('duration') or 0
+        self.position = position
+        self.frames = 0
+        self.finished = False
+
+    def elapsed(self):
+        return self.position + self.frames * FRAME_SECONDS
+
+    def read(self, volume):
+        self.source.volume = volume
+        try:
+            data = self.source.read()
+        except Exception as e:
+            underlying_source(self.source)._current_error = e
+            return b''
+        self.frames += 1
+        return data
+
+    def error(self):
+        return getattr(underlying_source(self.source), '_current_error', None)
+
+    def cleanup(self):
+        self.source.cleanup()
+
+class MixerSource(discord.AudioSource):
+    """PCM текущего и следующего треков. Команды из цикла событий применяются в аудиопотоке
+    в начале следующего кадра, поэтому состоянием декодеров владеет только аудиопоток"""
+
+    def __init__(self, player, volume=1.0):
+        self.player = player
+        self.volume = volume
+        self.commands = deque()
+        self.current = None
+        self.next = None
+        # Уходящий трек во время кроссфейда
+        self.outgoing = None
+        self.fade_frames = 0
+        self.fade_total = 0
+        self.idle_frames = 0
+        self.counters = {'tracks': 0, 'gapless': 0, 'crossfades': 0, 'idle_frames': 0}
+
+    def play(self, deck):
+        """Немедленная смена трека: первый трек, пропуск, перемотка"""
+        self.commands.append(('play', deck))
+
+    def queue_next(self, deck):
+        self.commands.append(('next', deck))
+
+    def clear(self):
+        self.commands.append(('play', None))
+
+    def decks(self):
+        decks = [self.current, self.next, self.outgoing]
+        decks += [deck for _, deck in list(self.commands)]
+        return [deck for deck in decks if deck is not None]
+
+    def notify(self, event, *args):
+        bot.loop.call_soon_threadsafe(self.player.post, event, *args)
+
+    def _apply_commands(self):
+        while self.commands:
+            command, deck = self.commands.popleft()
+            if command == 'next':
+                old = [self.next]
+                self.next = deck
+            else:
+                old = [self.current, self.next, self.outgoing]
+                self.current, self.next, self.outgoing = deck, None, None
+                self.idle_frames = 0
+                if deck is not None:
+                    self.counters['tracks'] += 1
+            for deck in old:
+                if deck is not None:
+                    deck.cleanup()
+
+    def _switch(self):
+        """Следующий трек становится текущим; цикл событий обновляет очередь и сообщение"""
+        deck = self.next
+        self.next = None
+        self.current = deck
+        self.counters['tracks'] += 1
+        self.notify('mixer_switch', deck)
+        return deck
+
+    def read(self):
+        """Вызывается аудиопотоком discord.py каждые 20 мс"""
+        self._apply_commands()
+        current = self.current
+        if current is None:
+            return self._idle()
+
+        # Кроссфейд начинается, пока текущий трек еще звучит
+        fade = crossfade_seconds()
+        if fade and self.next and self.outgoing is None and current.duration and current.duration - current.elapsed() <= fade:
+            self.outgoing, self.fade_frames, self.fade_total = current, 0, max(1, int(fade / FRAME_SECONDS))
+            self.counters['crossfades'] += 1
+            current = self._switch()
+
+        data = current.read(self.volume)
+        if len(data) < FRAME_SIZE:
+            error = self._finish(current)
+            if self.next and error is None:
+                # Стык без паузы: первый кадр следующего трека уходит в том же такте
+                self.counters['gapless'] += 1
+                current = self._switch()
+                data = current.read(self.volume)
+                if len(data) < FRAME_SIZE:
+                    # Подготовленный трек не запустился
+                    self._end(current, self._finish(current))
+                    data = b''
+            else:
+                self._end(current, error)
+                data = b''
+
+        if self.outgoing is not None:
+            data = self._fade(data)
+        return data if len(data) == FRAME_SIZE else self._idle()
+
+    def _finish(self, deck):
+        deck.finished = True
+        error = deck.error()
+        deck.cleanup()
+        return error
+
+    def _end(self, deck, error):
+        """Трек закончился, а следующего нет: его выберет проигрыватель"""
+        self.current = None
+        self.notify('track_end', deck.generation, error)
+
+    def _fade(self, incoming):
+        outgoing = self.outgoing.read(self.volume)
+        start = self.fade_frames / self.fade_total
+        self.fade_frames += 1
+        if len(outgoing) == FRAME_SIZE:
+            incoming = mix_frames(outgoing, incoming if len(incoming) == FRAME_SIZE else SILENCE_FRAME, start, self.fade_frames / self.fade_total)
+        if len(outgoing) < FRAME_SIZE or self.fade_frames >= self.fade_total:
+            self.outgoing.cleanup()
+            self.outgoing = None
+        return incoming
+
+    def _idle(self):
+        """Тишина в ожидании следующего трека; по истечении ожидания микшер отпускает голосовой клиент"""
+        self.idle_frames += 1
+        self.counters['idle_frames'] += 1
+        if self.idle_frames * FRAME_SECONDS > MIXER_IDLE_SECONDS:
+            return b''
+        return SILENCE_FRAME
+
+    def cleanup(self):
+        # Неприменённые команды остаются: по ним проигрыватель поймет, что трек не успел начаться
+        for deck in self.decks():
+            deck.cleanup()
+        self.current = self.next = self.outgoing = None
+
+def mixer_report():
+    mixers = [
+        state.player.mixer for state in server_states.values()
+        if state.player.mixer is not None
+    ]
+    totals = {}
+    for mixer in mixers:
+        for name, count in mixer.counters.items():
+            totals[name] = totals.get(name, 0) + count
+    mode = f"кроссфейд {crossfade_seconds()}с" if crossfade_seconds() else "стык без паузы"
+    if not MIXER_ENABLED:
+        mode = "выключен"
+    return f"Микшер: {mode}, активных {len(mixers)}" + "".join(f" | {name}: {count}" for name, count in totals.items())
+
+# Как часто замерять задержку цикла событий и с какой задержки считать его зависшим
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_THRESHOLD = 0.25
+
+# Монитор задержки цикла событий: корутина просыпается каждые LOOP_LAG_INTERVAL и замеряет опоздание,
+# а сторожевой поток во время зависания снимает стек главного потока, чтобы найти виновника
+class LoopMonitor:
+    def __init__(self):
+        self.samples = deque(maxlen=1200)
+        self.stalls = deque(maxlen=20)
+        self.stall_count = 0
+        self.heartbeat = time.monotonic()
+        self.captured = None
+        self.loop = None
+        self.loop_thread_id = None
+        self.task = None
+
+    def start(self):
+        if self.task is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.task = asyncio.create_task(self._sample())
+        threading.Thread(target=self._watchdog, name='loop-watchdog', daemon=True).start()
+
+    async def _sample(self):
+        while True:
+            started = self.heartbeat = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, time.monotonic() - started - LOOP_LAG_INTERVAL)
+            self.samples.append(lag)
+            if lag >= LOOP_LAG_THRESHOLD:
+                captured = self.captured
+                self._record_stall(lag, captured if captured and captured['since'] == started else None)
+            self.captured = None
+
+    def _watchdog(self):
+        while True:
+            time.sleep(LOOP_LAG_THRESHOLD / 2)
+            since = self.heartbeat
+            if self.captured is None and time.monotonic() - since > LOOP_LAG_INTERVAL + LOOP_LAG_THRESHOLD:
+                self.captured = self._capture(since)
+
+    def _capture(self, since):
+        """Что выполняет главный поток прямо сейчас: текущая задача и хвост стека"""
+        try:
+            task = asyncio.current_task(self.loop)
+        except Exception:
+            task = None
+        coro = task.get_coro() if task else None
+        frame = sys._current_frames().get(self.loop_thread_id)
+        stack = traceback.extract_stack(frame)[-6:] if frame else []
+        return {
+            'since': since,
+            'task': getattr(coro, '__qualname__', None) or "обратный вызов",
+            'stack': [f"{os.path.basename(entry.filename)}:{entry.lineno} {entry.name}" for entry in stack]
+        }
+
+    def _record_stall(self, lag, captured):
+        self.stall_count += 1
+        stall = {
+            'at': time.monotonic(),
+            'lag': lag,
+            'task': captured['task'] if captured else "неизвестно",
+            'stack': captured['stack'] if captured else []
+        }
+        self.stalls.append(stall)
+        print(f"Цикл событий завис на {lag * 1000:.0f} мс: {stall['task']}")
+        for line in stall['stack']:
+            print(f"    {line}")
+
+    def recent_max(self, seconds):
+        """Наибольшая задержка за последние seconds секунд"""
+        count = max(1, int(seconds / LOOP_LAG_INTERVAL))
+        return max(list(self.samples)[-count:], default=0.0)
+
+    def percentile(self, fraction):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+    def report(self):
+        if not self.samples:
+            return "Нет данных"
+        now = time.monotonic()
+        lines = [
+            f"Задержка цикла за {len(self.samples) * LOOP_LAG_INTERVAL / 60:.0f} мин: "
+            f"p50 {self.percentile(0.5) * 1000:.0f} мс, p95 {self.percentile(0.95) * 1000:.0f} мс, "
+            f"макс {max(self.samples) * 1000:.0f} мс | зависаний от {LOOP_LAG_THRESHOLD * 1000:.0f} мс: {self.stall_count}",
+            f"Пинг шлюза: {bot.latency * 1000:.0f} мс | цикл событий: `{type(self.loop).__module__}`"
+        ]
+        for stall in list(self.stalls)[-5:]:
+            lines.append(
+                f"{format_duration(now - stall['at'])} назад: {stall['lag'] * 1000:.0f} мс в `{stall['task']}`"
+            )
+            if stall['stack']:
+                lines.append(f"`{stall['stack'][-1]}`")
+        return "\n".join(lines)
+
+loop_monitor = LoopMonitor()
+
+# Уровни перегрузки и что на каждом отключается (уровни включают все предыдущие):
+# 1 — обновление прогресс-бара "Сейчас играет" и отложенная предзагрузка треков
+# 2 — ffmpeg для новых треков запускается в один поток
+# 3 — новые плейлисты не принимаются
+OVERLOAD_CHECK_INTERVAL = 5
+# Пороги загрузки процессора (доля от всех ядер) и задержки цикла событий (с) для уровней 1-3
+OVERLOAD_CPU_LEVELS = (0.80, 0.90, 0.97)
+OVERLOAD_LAG_LEVELS = (0.10, 0.25, 0.50)
+# Проигрыватель, отставший от расписания кадров больше чем на это (с), считается опаздывающим
+AUDIO_LATE_THRESHOLD = 0.1
+# Сколько проверок подряд нагрузка должна быть ниже, чтобы снизить уровень на один
+OVERLOAD_CALM_CHECKS = 3
+PREFETCH_DELAY = 10
+
+def threshold_level(value, levels):
+    return sum(1 for threshold in levels if value >= threshold)
+
+# Контроллер перегрузки: по загрузке процессора, задержке цикла событий и опаздывающим
+# аудиокадрам отключает второстепенную работу, чтобы звук у текущих слушателей не прерывался
+class OverloadController:
+    def __init__(self):
+        self.level = 0
+        self.calm_checks = 0
+        self.signals = {'cpu': 0.0, 'lag': 0.0, 'late': 0}
+        self.counters = {'progress_skipped': 0, 'prefetch_delayed': 0, 'playlists_rejected': 0}
+        self.last_cpu = None
+
+    def cpu_load(self):
+        """Загрузка процессора хоста: psutil или средняя нагрузка за минуту"""
+        if psutil is not None:
+            return psutil.cpu_percent(interval=None) / 100
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+        except OSError:
+            return 0.0
+
+    def late_players(self):
+        """Сколько проигрывателей отстают от расписания отправки кадров"""
+        now = time.perf_counter()
+        late = 0
+        for state in list(server_states.values()):
+            voice_client = state.voice_client
+            player = getattr(voice_client, '_player', None)
+            if player is None or not voice_client.is_playing():
+                continue
+            expected = player._start + player.DELAY * (player.loops + 1)
+            if now - expected > AUDIO_LATE_THRESHOLD:
+                late += 1
+        return late
+
+    def check(self):
+        cpu = self.cpu_load()
+        lag = loop_monitor.recent_max(OVERLOAD_CHECK_INTERVAL)
+        late = self.late_players()
+        self.signals = {'cpu': cpu, 'lag': lag, 'late': late}
+
+        level = max(
+            threshold_level(cpu, OVERLOAD_CPU_LEVELS),
+            threshold_level(lag, OVERLOAD_LAG_LEVELS),
+            2 if late else 0
+        )
+        # Уровень поднимается сразу, а снижается по одному после нескольких спокойных проверок
+        if level >= self.level:
+            self.calm_checks = 0
+            self.set_level(level)
+        else:
+            self.calm_checks += 1
+            if self.calm_checks >= OVERLOAD_CALM_CHECKS:
+                self.calm_checks = 0
+                self.set_level(self.level - 1)
+
+    def set_level(self, level):
+        if level != self.level:
+            print(
+                f"Уровень перегрузки {self.level} -> {level} "
+                f"(CPU {self.signals['cpu'] * 100:.0f}%, задержка цикла {self.signals['lag'] * 1000:.0f} мс, "
+                f"опаздывающих проигрывателей: {self.signals['late']})"
+            )
+        self.level = level
+
+    def shed_progress(self):
+        if self.level >= 1:
+            self.counters['progress_skipped'] += 1
+            return True
+        return False
+
+    def prefetch_delay(self):
+        if self.level >= 1:
+            self.counters['prefetch_delayed'] += 1
+            return PREFETCH_DELAY
+        return 0
+
+    def ffmpeg_options(self, base=None):
+        base = base or ffmpeg_options
+        if self.level >= 2:
+            return dict(base, before_options=base['before_options'].replace('-threads 2', '-threads 1'))
+        return base
+
+    def accept_playlist(self):
+        if self.level >= 3:
+            self.counters['playlists_rejected'] += 1
+            return False
+        return True
+
+    def report(self):
+        return (
+            f"Уровень: {self.level} | CPU {self.signals['cpu'] * 100:.0f}%, "
+            f"задержка цикла {self.signals['lag'] * 1000:.0f} мс, опаздывающих проигрывателей: {self.signals['late']}\n"
+            + " | ".join(f"{name}: {count}" for name, count in self.counters.items())
+        )
+
+overload = OverloadController()
+
+@tasks.loop(seconds=OVERLOAD_CHECK_INTERVAL)
+async def check_overload():
+    overload.check()
 
 # Вспомогательные функции
 def format_duration(seconds):
@@ -90,6 +1446,15 @@ def create_embed(title, description=None, color=0x4682B4):
                      icon_url="https://github.com/N0-LABEL/Kasseta/blob/main/mkrf.png?raw=true")
     return embed
 
+def requester_mention(track):
+    """Упоминание добавившего трек; в сжатом состоянии хранится только его id"""
+    user = track.get('user')
+    if user is not None:
+        return user.mention
+    if track.get('user_id'):
+        return f"<@{track['user_id']}>"
+    return "—"
+
 def create_progress_bar(position, duration, length=15):
     if duration <= 0:
         return ""
@@ -103,53 +1468,309 @@ def is_playlist_url(url):
 def is_valid_url(url):
     return url.startswith(('http://', 'https://', 'www.'))
 
-async def extract_info_async(search, playlist=False):
-    """Асинхронное извлечение информации о треке"""
-    cache_key = f"{'playlist_' if playlist else 'track_'}{search}"
-
-    # Проверяем кэш
+YOUTUBE_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com', 'music.youtube.com',
+                 'youtube-nocookie.com', 'www.youtube-nocookie.com')
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def youtube_media_key(url):
+    """Разбор ссылки YouTube в ('youtube', id) без обращения к yt-dlp"""
+    if url.startswith('www.'):
+        url = 'https://' + url
+    parsed = urlsplit(url)
+    host = parsed.netloc.lower().split(':')[0]
+    video_id = None
+
+    if host in ('youtu.be', 'www.youtu.be'):
+        video_id = parsed.path.strip('/').split('/')[0]
+    elif host in YOUTUBE_HOSTS:
+        query = parse_qs(parsed.query)
+        if 'v' in query:
+            video_id = query['v'][0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v'):
+                video_id = parts[1]
+
+    if video_id and YOUTUBE_ID_RE.match(video_id):
+        return ('youtube', video_id)
+    return None
+
+@functools.lru_cache(maxsize=1024)
+def match_extractor(url):
+    """Поиск экстрактора yt-dlp для ссылки и id медиа в ней"""
+    for ie in youtube_dl.extractor.gen_extractor_classes():
+        if ie.ie_key() == 'Generic' or not ie.suitable(url):
+            continue
+        try:
+            media_id = ie.get_temp_id(url)
+        except Exception:
+            media_id = None
+        return (ie.ie_key().lower(), media_id) if media_id else None
+    return None
+
+def media_key(info):
+    """Канонический ключ для уже извлеченной информации"""
+    extractor = (info.get('extractor_key') or info.get('ie_key') or info.get('extractor') or '').lower()
+    media_id = info.get('id')
+    if not extractor or not media_id:
+        return None
+    return f"{extractor}:{media_id}"
+
+def query_cache_key(query):
+    """Ключ кэша для текстового запроса: регистр и лишние пробелы не важны"""
+    return f"track_query:{' '.join(query.split()).lower()}"
+
+def playlist_cache_key(url):
+    """Ключ кэша плейлиста: для YouTube по id списка, иначе по самой ссылке"""
+    list_id = parse_qs(urlsplit(url).query).get('list')
+    if list_id:
+        return f"playlist_youtube:{list_id[0]}"
+    return f"playlist_{url.split('#')[0]}"
+
+async def canonical_cache_key(search):
+    """Ключ кэша, общий для всех вариантов ссылки на одно и то же медиа"""
+    if not is_valid_url(search):
+        return query_cache_key(search)
+
+    key = youtube_media_key(search)
+    if key is None:
+        await ensure_ytdl()
+        key = await run_in_executor(match_extractor, search.split('#')[0])
+    if key is None:
+        return f"track_{search.split('#')[0]}"
+    return f"track_{key[0]}:{key[1]}"
+
+async def extract_info_async(search):
+    """Асинхронное извлечение информации о треке; плейлисты загружаются через get_playlist_records"""
+    cache_key = await canonical_cache_key(search)
+
+    # Проверяем кэш: запросы в search_cache, отдельные треки в track_cache
     if cache_key in search_cache:
         return search_cache[cache_key]
+    track_key = cache_key.split('_', 1)[1]
+    if track_key in track_cache:
+        return track_cache[track_key]
+
+    # Если это же извлечение уже идет (например, фоновое из ?search), ждем его
+    if cache_key in pending_extractions:
+        return await asyncio.shield(pending_extractions[cache_key])
 
+    task = asyncio.ensure_future(_extract_info_uncached(search, cache_key))
+    pending_extractions[cache_key] = task
+    task.add_done_callback(lambda _: pending_extractions.pop(cache_key, None))
+    return await asyncio.shield(task)
+
+async def _extract_info_uncached(search, cache_key):
     # Извлекаем информацию в отдельном потоке
     loop = asyncio.get_event_loop()
-    options = ytdl_format_options.copy()
-    options['noplaylist'] = not playlist
+    await ensure_ytdl()
 
     try:
-        # Используем functools.partial для передачи параметров
-        func = functools.partial(extract_info_sync, search, playlist)
-        info = await loop.run_in_executor(executor, func)
+        info = await loop.run_in_executor(executor, extract_info_sync, search)
 
         # Кэшируем результат
         if info:
             search_cache[cache_key] = info
-            # Для отдельных треков также кэшируем URL
-            if not playlist and 'entries' not in info:
-                track_url = info.get('url')
-                if track_url:
-                    track_cache[track_url] = info
+            # Отдельные треки также кэшируем по каноническому ключу,
+            # чтобы поиск по тексту и любая ссылка на то же видео давали попадание
+            track_info = info['entries'][0] if info.get('entries') else info
+            key = media_key(track_info) if track_info else None
+            if key:
+                track_cache[key] = track_info
 
         return info
     except Exception as e:
         print(f"Ошибка извлечения информации: {e}")
         return None
 
-def extract_info_sync(search, playlist=False):
+def extract_info_sync(search):
     """Синхронное извлечение информации о треке"""
+    with youtube_dl.YoutubeDL(ytdl_format_options) as ytdl:
+        try:
+            return ytdl.extract_info(search, download=False)
+        except Exception as e:
+            print(f"Ошибка синхронного извлечения: {e}")
+            return None
+
+def search_flat_sync(query, count=4):
+    """Быстрый поиск без извлечения форматов: только id, название и длительность"""
     options = ytdl_format_options.copy()
-    options['noplaylist'] = not playlist
+    options['extract_flat'] = 'in_playlist'
+
+    with youtube_dl.YoutubeDL(options) as ytdl:
+        try:
+            info = ytdl.extract_info(f"ytsearch{count}:{query}", download=False)
+        except Exception as e:
+            print(f"Ошибка поиска: {e}")
+            return []
+
+    if not info:
+        return []
+    return [entry for entry in info.get('entries') or [] if entry]
+
+async def search_flat_async(query, count=4):
+    """Асинхронный плоский поиск с кэшированием результатов"""
+    cache_key = f"{count}_{query_cache_key(query)}"
+    if cache_key in search_results_cache:
+        return search_results_cache[cache_key]
+
+    await ensure_ytdl()
+    results = await run_in_executor(search_flat_sync, query, count)
+    if results:
+        search_results_cache[cache_key] = results
+    return results
+
+PLAYLIST_CACHE_DIR = os.path.join(DATA_DIR, 'playlist_cache')
+# Плейлист из кэша старше этого сверяется с YouTube в фоне
+PLAYLIST_FRESH_SECONDS = 3600
+# Сколько первых треков запрашивать для сверки с кэшем
+PLAYLIST_PAGE_SIZE = 100
+# Заглушки вместо удаленных и скрытых видео в плоском списке плейлиста
+UNAVAILABLE_TITLES = ('[Private video]', '[Deleted video]')
+
+# Кэш плейлистов в памяти: порядок треков и компактные записи, полные копии лежат на диске
+playlist_cache = TTLCache(maxsize=50, ttl=3600)
+playlist_cache_stats = {'hits': 0, 'unchanged': 0, 'incremental': 0, 'full': 0}
+
+def playlist_cache_path(key):
+    return os.path.join(PLAYLIST_CACHE_DIR, f"{hashlib.sha1(key.encode()).hexdigest()[:20]}.json")
+
+def read_playlist_cache(key):
+    try:
+        with open(playlist_cache_path(key), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"Ошибка загрузки кэша плейлиста: {e}")
+        return None
 
-    # Для URL проверяем кэш
-    if is_valid_url(search) and not playlist and search in track_cache:
-        return track_cache[search]
+def write_playlist_cache(entry):
+    os.makedirs(PLAYLIST_CACHE_DIR, exist_ok=True)
+    path = playlist_cache_path(entry['key'])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def extract_playlist_flat_sync(url, end=None):
+    """Плоский список плейлиста (id, название, длительность) без извлечения форматов.
+    Возвращает записи и общее число треков, если yt-dlp его знает"""
+    options = ytdl_format_options.copy()
+    options['noplaylist'] = False
+    options['extract_flat'] = 'in_playlist'
+    if end:
+        options['playlistend'] = end
 
     with youtube_dl.YoutubeDL(options) as ytdl:
         try:
-            return ytdl.extract_info(search, download=False)
+            info = ytdl.extract_info(url, download=False)
         except Exception as e:
-            print(f"Ошибка синхронного извлечения: {e}")
+            print(f"Ошибка извлечения плейлиста: {e}")
+            return None, None
+
+    if not info:
+        return None, None
+    records = []
+    for entry in info.get('entries') or []:
+        if not entry or not entry.get('id') or entry.get('title') in UNAVAILABLE_TITLES:
+            continue
+        track = process_flat_entry(entry)
+        records.append({key: track[key] for key in ('id', 'title', 'duration', 'webpage_url')})
+    return records, info.get('playlist_count')
+
+def merge_playlist_page(cached, page, total):
+    """Сверка первой страницы с кэшем. Если в начало плейлиста только добавились треки,
+    возвращает обновленный список целиком, иначе None — нужна полная загрузка"""
+    if len(page) < PLAYLIST_PAGE_SIZE:
+        # Первая страница и есть весь плейлист
+        return page
+
+    cached_ids = [record['id'] for record in cached]
+    page_ids = [record['id'] for record in page]
+    for added in range(len(page_ids)):
+        rest = page_ids[added:]
+        if cached_ids[:len(rest)] == rest:
+            merged = page[:added] + cached
+            if total is None or len(merged) == total:
+                return merged
             return None
+    return None
+
+async def refresh_playlist(key, url, cached):
+    """Обновление плейлиста в кэше: сначала по первой странице, полная загрузка — только если не сошлось"""
+    await ensure_ytdl()
+    page, total = await run_in_executor(extract_playlist_flat_sync, url, PLAYLIST_PAGE_SIZE)
+    if page is None:
+        return cached
+
+    records = merge_playlist_page(cached['entries'], page, total) if cached else None
+    if records is not None:
+        unchanged = [record['id'] for record in records] == [record['id'] for record in cached['entries']]
+        playlist_cache_stats['unchanged' if unchanged else 'incremental'] += 1
+    elif len(page) < PLAYLIST_PAGE_SIZE:
+        records = page
+        playlist_cache_stats['full'] += 1
+    else:
+        records, _ = await run_in_executor(extract_playlist_flat_sync, url)
+        if records is None:
+            return cached
+        playlist_cache_stats['full'] += 1
+
+    entry = {'key': key, 'refreshed': time.time(), 'entries': records}
+    playlist_cache[key] = entry
+    try:
+        await run_in_executor(write_playlist_cache, entry)
+    except OSError as e:
+        print(f"Ошибка сохранения кэша плейлиста: {e}")
+    return entry
+
+def refresh_playlist_once(key, url, cached):
+    """Одно обновление плейлиста на все одновременные запросы"""
+    pending_key = f"refresh_{key}"
+    if pending_key not in pending_extractions:
+        task = asyncio.ensure_future(refresh_playlist(key, url, cached))
+        pending_extractions[pending_key] = task
+        task.add_done_callback(lambda _: pending_extractions.pop(pending_key, None))
+    return pending_extractions[pending_key]
+
+async def get_playlist_records(url):
+    """Записи треков плейлиста: известный плейлист отдается из кэша сразу,
+    а устаревший сверяется с YouTube в фоне для следующих загрузок"""
+    key = playlist_cache_key(url)
+    entry = playlist_cache.get(key)
+    if entry is None:
+        entry = await run_in_executor(read_playlist_cache, key)
+
+    if entry is not None:
+        playlist_cache[key] = entry
+        playlist_cache_stats['hits'] += 1
+        if time.time() - entry['refreshed'] > PLAYLIST_FRESH_SECONDS:
+            refresh_playlist_once(key, url, entry)
+        return entry['entries']
+
+    entry = await asyncio.shield(refresh_playlist_once(key, url, None))
+    return entry['entries'] if entry else None
+
+# Сколько треков брать из микса YouTube для автовоспроизведения
+AUTOPLAY_MIX_SIZE = 25
+# Миксы по id трека: соседние треки одного микса часто тоже становятся затравкой
+autoplay_mix_cache = TTLCache(maxsize=200, ttl=3600)
+
+async def autoplay_candidates(track):
+    """Похожие треки из микса YouTube (список RD<id>) для трека с YouTube"""
+    key = youtube_media_key(track.get('webpage_url') or '')
+    if key is None:
+        return []
+    video_id = key[1]
+    if video_id not in autoplay_mix_cache:
+        await ensure_ytdl()
+        url = f"https://www.youtube.com/watch?v={video_id}&list=RD{video_id}"
+        records, _ = await run_in_executor(extract_playlist_flat_sync, url, AUTOPLAY_MIX_SIZE)
+        if records is None:
+            return []
+        autoplay_mix_cache[video_id] = [record for record in records if record['id'] != video_id]
+    return autoplay_mix_cache[video_id]
 
 def process_track(info):
     if 'entries' in info:
@@ -159,15 +1780,923 @@ def process_track(info):
         'url': info['url'],
         'title': info['title'],
         'duration': info.get('duration', 0),
+        'id': info.get('id'),
+        'webpage_url': info.get('webpage_url') or info.get('original_url'),
         'user': None
     }
 
-async def add_to_queue(ctx, track):
+def process_flat_entry(entry):
+    """Трек из плоского результата: ссылка на поток будет получена перед воспроизведением"""
+    return {
+        'url': None,
+        'title': entry.get('title') or entry.get('id'),
+        'duration': entry.get('duration') or 0,
+        'id': entry.get('id'),
+        'webpage_url': entry.get('webpage_url') or entry.get('url'),
+        'user': None
+    }
+
+async def resolve_track(track, queue=None):
+    """Получение ссылки на поток для трека, добавленного без нее;
+    если трек еще в очереди queue, ее общая длительность обновляется вместе с ним"""
+    if track.get('url'):
+        return track
+
+    # Трек локальной библиотеки: достаточно убедиться, что файл на месте
+    if track['webpage_url'].startswith(LOCAL_PREFIX):
+        path = track['webpage_url'][len(LOCAL_PREFIX):]
+        if not os.path.isfile(path):
+            return None
+        track['url'] = path
+        return track
+
+    info = await extract_info_async(track['webpage_url'])
+    if not info:
+        return None
+
+    resolved = process_track(info)
+    track['url'] = resolved['url']
+    if queue is not None:
+        queue.set_duration(track, track.get('duration') or resolved['duration'])
+    else:
+        track['duration'] = track.get('duration') or resolved['duration']
+    return track
+
+def prefetch_track(track, query=None):
+    """Фоновое получение ссылки на поток; результат попадет в кэш"""
+    async def _prefetch():
+        # Под нагрузкой предзагрузка подождет: она не нужна для уже играющего звука
+        delay = overload.prefetch_delay()
+        if delay:
+            await asyncio.sleep(delay)
+        info = await extract_info_async(track['webpage_url'])
+        if not info:
+            return
+        # Мертвая ссылка не должна остаться в кэше до воспроизведения
+        checked = await ensure_stream_alive(dict(process_track(info), webpage_url=track['webpage_url']))
+        if checked is None:
+            return
+        # Первый результат поиска совпадает с тем, что найдет ?play по тому же запросу
+        if query:
+            search_cache[query_cache_key(query)] = info
+
+    return asyncio.create_task(_prefetch())
+
+# Локальная музыкальная библиотека: каталог с файлами; None — библиотека отключена
+LOCAL_LIBRARY_DIR = None
+LIBRARY_DB_PATH = os.path.join(DATA_DIR, 'library.sqlite3')
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav')
+LIBRARY_RESCAN_INTERVAL = 600
+LIBRARY_SCAN_WORKERS = 4
+# Сколько кандидатов из индекса проверять, если в запросе есть короткие слова и номера
+LIBRARY_SEARCH_CANDIDATES = 50
+# Треки библиотеки хранятся с webpage_url вида "local:/путь/к/файлу"
+LOCAL_PREFIX = 'local:'
+# Файлу с диска переподключение не нужно
+local_ffmpeg_options = {
+    'before_options': '-threads 2',
+    'options': '-vn'
+}
+
+LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT,
+    album TEXT,
+    duration INTEGER NOT NULL DEFAULT 0
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, artist, album, content='tracks', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+    INSERT INTO tracks_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+END;
+"""
+
+def read_audio_tags(path):
+    """Теги и длительность файла: через mutagen, если он установлен, иначе через ffprobe.
+    Выполняется в процессах пула при сканировании"""
+    tags = {'title': None, 'artist': None, 'album': None, 'duration': 0}
+    try:
+        if mutagen is not None:
+            audio = mutagen.File(path, easy=True)
+            if audio is not None:
+                for key in ('title', 'artist', 'album'):
+                    values = audio.get(key)
+                    tags[key] = values[0] if values else None
+                tags['duration'] = int(audio.info.length) if audio.info else 0
+        else:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', path],
+                capture_output=True, timeout=15
+            )
+            file_format = json.loads(result.stdout or b'{}').get('format', {})
+            file_tags = {key.lower(): value for key, value in (file_format.get('tags') or {}).items()}
+            for key in ('title', 'artist', 'album'):
+                tags[key] = file_tags.get(key)
+            tags['duration'] = int(float(file_format.get('duration') or 0))
+    except Exception as e:
+        print(f"Ошибка чтения тегов {path}: {e}")
+
+    if not tags['title']:
+        tags['title'] = os.path.splitext(os.path.basename(path))[0]
+    return tags
+
+# Индекс локальной библиотеки в SQLite с полнотекстовым (триграммным) поиском
+class LocalLibrary:
+    def __init__(self, root, db_path):
+        self.root = root
+        self.db_path = db_path
+        self.scan_lock = threading.Lock()
+        self.stats = {'files': 0, 'read': 0, 'removed': 0, 'hits': 0, 'misses': 0}
+        self.last_scan = None
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def init_db(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self.connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(LIBRARY_SCHEMA)
+        finally:
+            conn.close()
+
+    def scan(self):
+        """Сканирование каталога: теги читаются только у новых и измененных (по mtime и размеру) файлов"""
+        with self.scan_lock:
+            started = time.monotonic()
+            self.init_db()
+
+            found = {}
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if not filename.lower().endswith(LIBRARY_EXTENSIONS):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_mtime, stat.st_size)
+
+            conn = self.connect()
+            try:
+                known = {path: (mtime, size) for path, mtime, size in conn.execute('SELECT path, mtime, size FROM tracks')}
+                changed = [path for path, meta in found.items() if known.get(path) != meta]
+                removed = [path for path in known if path not in found]
+
+                if changed:
+                    # spawn, а не fork: в процессе бота работают цикл событий и потоки, их блокировки не должны попасть в дочерние процессы
+                    with ProcessPoolExecutor(max_workers=LIBRARY_SCAN_WORKERS, mp_context=multiprocessing.get_context('spawn')) as pool:
+                        all_tags = list(pool.map(read_audio_tags, changed, chunksize=32))
+                    conn.executemany(
+                        'INSERT INTO tracks (path, mtime, size, title, artist, album, duration) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size, '
+                        'title = excluded.title, artist = excluded.artist, album = excluded.album, duration = excluded.duration',
+                        [
+                            (path, *found[path], tags['title'], tags['artist'], tags['album'], tags['duration'])
+                            for path, tags in zip(changed, all_tags)
+                        ]
+                    )
+                conn.executemany('DELETE FROM tracks WHERE path = ?', [(path,) for path in removed])
+                conn.commit()
+            finally:
+                conn.close()
+
+            self.stats['files'] = len(found)
+            self.stats['read'] += len(changed)
+            self.stats['removed'] += len(removed)
+            self.last_scan = (time.time(), time.monotonic() - started)
+            if changed or removed:
+                print(f"Библиотека: {len(found)} файлов, прочитано {len(changed)}, удалено {len(removed)}")
+
+    def search(self, query, limit=1):
+        """Поиск по названию, исполнителю и альбому: все слова запроса должны найтись.
+        Слова от 3 символов ищет индекс триграмм, а короткие слова и номера ("no 9", "op 48")
+        проверяются целиком среди кандидатов"""
+        tokens = re.findall(r'\w+', query.lower())
+        words = [word for word in tokens if len(word) >= 3]
+        short = {word for word in tokens if len(word) < 3}
+        if not words:
+            return []
+        match = ' AND '.join(f'"{word}"' for word in words)
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                'SELECT tracks.id, tracks.path, tracks.title, tracks.artist, tracks.duration, tracks.album '
+                'FROM tracks_fts JOIN tracks ON tracks.id = tracks_fts.rowid '
+                'WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT ?',
+                (match, LIBRARY_SEARCH_CANDIDATES if short else limit)
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            # Индекс еще не создан первым сканированием
+            print(f"Ошибка поиска в библиотеке: {e}")
+            return []
+        finally:
+            conn.close()
+
+        found = []
+        for row in rows:
+            text = ' '.join(part for part in (row[2], row[3], row[5]) if part)
+            if short <= set(re.findall(r'\w+', text.lower())):
+                found.append(row[:5])
+        return found[:limit]
+
+    def report(self):
+        lines = [f"Каталог: `{self.root}` | " + " | ".join(f"{name}: {count}" for name, count in self.stats.items())]
+        if self.last_scan:
+            finished, seconds = self.last_scan
+            lines.append(f"Последнее сканирование: {format_duration(time.time() - finished)} назад, за {seconds:.1f}с")
+        return "\n".join(lines)
+
+library = LocalLibrary(LOCAL_LIBRARY_DIR, LIBRARY_DB_PATH) if LOCAL_LIBRARY_DIR else None
+
+def library_track(row):
+    track_id, path, title, artist, duration = row
+    return {
+        'url': path,
+        'title': f"{artist} — {title}" if artist else title,
+        'duration': duration or 0,
+        'id': f"local{track_id}",
+        'webpage_url': LOCAL_PREFIX + path,
+        'user': None
+    }
+
+async def search_library(query):
+    """Трек из локальной библиотеки по текстовому запросу или None"""
+    if library is None:
+        return None
+    rows = await run_in_executor(library.search, query)
+    if not rows:
+        library.stats['misses'] += 1
+        return None
+    library.stats['hits'] += 1
+    return library_track(rows[0])
+
+@tasks.loop(seconds=LIBRARY_RESCAN_INTERVAL)
+async def rescan_library():
+    try:
+        await run_in_executor(library.scan)
+    except Exception as e:
+        print(f"Ошибка сканирования библиотеки: {e}")
+
+HISTORY_PATH = os.path.join(DATA_DIR, 'history.json')
+HISTORY_MAX_ENTRIES = 5000
+# Сколько разных запросов запоминать для одного трека
+HISTORY_MAX_ALIASES = 5
+# Минимальное сходство (коэффициент Дайса по триграммам), при котором запрос считается повтором
+HISTORY_MATCH_THRESHOLD = 0.85
+
+def title_trigrams(text):
+    """Триграммы слов текста; порядок слов и регистр не важны"""
+    grams = set()
+    for word in re.findall(r'\w+', text.lower()):
+        padded = f" {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+def exact_tokens(text):
+    """Номера и короткие слова: они дают всего одну-две триграммы,
+    поэтому "Symphony No. 5" и "Symphony No. 9" почти неразличимы по сходству"""
+    return frozenset(
+        word for word in re.findall(r'\w+', text.lower())
+        if len(word) < 3 or any(char.isdigit() for char in word)
+    )
+
+# История воспроизведения: названия и запросы уже сыгранных треков с нечетким поиском по триграммам,
+# чтобы повторный запрос в другой формулировке не шел в ytsearch. Для прогрева кэшей в ней же
+# хранится, сколько раз трек играл в каждый час суток и на каких серверах
+class PlayHistory:
+    def __init__(self):
+        self.entries = {}
+        # Сколько треков играло на сервере в каждый час суток (ключ — id сервера строкой)
+        self.guild_hours = {}
+        self.aliases = []
+        self.postings = {}
+        self.stats = {'lookups': 0, 'hits': 0, 'misses': 0}
+        self.dirty = False
+
+    def rebuild(self):
+        self.aliases = []
+        self.postings = {}
+        for key, entry in self.entries.items():
+            for alias in [entry['title']] + entry['queries']:
+                self._index_alias(key, alias)
+
+    def _index_alias(self, key, alias):
+        grams = title_trigrams(alias)
+        if not grams:
+            return
+        index = len(self.aliases)
+        self.aliases.append((key, grams, frozenset(re.findall(r'\w+', alias.lower()))))
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(index)
+
+    def record(self, track, query=None):
+        """Трек и запрос, по которому он найден"""
+        entry = self._entry(track)
+        if entry is None:
+            return
+        key = track['id']
+        if query:
+            query = ' '.join(query.split()).lower()
+            if query not in entry['queries'] and len(entry['queries']) < HISTORY_MAX_ALIASES:
+                entry['queries'].append(query)
+                self._index_alias(key, query)
+        self.dirty = True
+
+    def count_play(self, track, guild_id):
+        """Трек начал играть: учитываем час суток и сервер"""
+        entry = self._entry(track)
+        if entry is None:
+            return
+        hour = datetime.datetime.now().hour
+        guild = str(guild_id)
+        entry['plays'] += 1
+        entry['hours'][hour] += 1
+        entry['guilds'][guild] = entry['guilds'].get(guild, 0) + 1
+        self.guild_hours.setdefault(guild, [0] * 24)[hour] += 1
+        self.dirty = True
+
+    def _entry(self, track):
+        key = track.get('id')
+        if not key or not track.get('webpage_url') or track['webpage_url'].startswith(LOCAL_PREFIX):
+            return None
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = {
+                'title': track['title'],
+                'duration': track.get('duration') or 0,
+                'webpage_url': track['webpage_url'],
+                'queries': [],
+                'plays': 0,
+                'hours': [0] * 24,
+                'guilds': {},
+                'last': time.time()
+            }
+            self._index_alias(key, entry['title'])
+            self._evict()
+        entry['last'] = time.time()
+        return entry
+
+    def _evict(self):
+        if len(self.entries) > HISTORY_MAX_ENTRIES:
+            # Забываем десятую часть самых давних треков и перестраиваем индекс
+            oldest = sorted(self.entries, key=lambda key: self.entries[key].get('last', 0))
+            for key in oldest[:HISTORY_MAX_ENTRIES // 10]:
+                del self.entries[key]
+            self.rebuild()
+
+    def match(self, query):
+        """Трек из истории, если запрос достаточно похож на его название или прошлый запрос"""
+        self.stats['lookups'] += 1
+        grams = title_trigrams(query)
+        required = exact_tokens(query)
+        overlaps = {}
+        for gram in grams:
+            for index in self.postings.get(gram, ()):
+                overlaps[index] = overlaps.get(index, 0) + 1
+
+        best, best_score = None, 0.0
+        for index, overlap in overlaps.items():
+            key, alias_grams, alias_tokens = self.aliases[index]
+            score = 2 * overlap / (len(grams) + len(alias_grams))
+            # Номера и короткие слова запроса должны быть в названии целиком
+            if score > best_score and required <= alias_tokens:
+                best, best_score = key, score
+
+        if best is None or best_score < HISTORY_MATCH_THRESHOLD or best not in self.entries:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        entry = self.entries[best]
+        return {
+            'url': None,
+            'title': entry['title'],
+            'duration': entry['duration'],
+            'id': best,
+            'webpage_url': entry['webpage_url'],
+            'user': None
+        }
+
+    def load(self):
+        try:
+            with open(HISTORY_PATH, encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Ошибка загрузки истории: {e}")
+            return
+        try:
+            # Старый формат: сам файл и есть словарь треков, без статистики по часам
+            entries = data['entries'] if 'entries' in data else data
+            for entry in entries.values():
+                entry.setdefault('plays', 0)
+                entry.setdefault('hours', [0] * 24)
+                entry.setdefault('guilds', {})
+                entry.setdefault('last', 0)
+            self.entries = entries
+            self.guild_hours = data.get('guild_hours', {}) if 'entries' in data else {}
+            self.rebuild()
+        except (KeyError, TypeError, AttributeError) as e:
+            print(f"Ошибка загрузки истории: {e}")
+            self.entries, self.guild_hours = {}, {}
+            self.rebuild()
+
+    def snapshot(self):
+        """JSON истории; собирается в цикле событий, пока записи не меняются"""
+        return json.dumps(
+            {'entries': self.entries, 'guild_hours': self.guild_hours},
+            ensure_ascii=False, separators=(',', ':')
+        )
+
+    def write(self, text):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        tmp_path = HISTORY_PATH + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, HISTORY_PATH)
+
+    def report(self):
+        lookups = self.stats['lookups']
+        hit_rate = self.stats['hits'] / lookups * 100 if lookups else 0
+        return (
+            f"Треков: {len(self.entries)}, ключей в индексе: {len(self.aliases)}, триграмм: {len(self.postings)}\n"
+            f"Запросов: {lookups}, попаданий: {self.stats['hits']} ({hit_rate:.0f}%), промахов: {self.stats['misses']}"
+        )
+
+play_history = PlayHistory()
+
+@tasks.loop(seconds=60)
+async def save_play_history():
+    if not play_history.dirty:
+        return
+    play_history.dirty = False
+    try:
+        await run_in_executor(play_history.write, play_history.snapshot())
+    except Exception as e:
+        # Запишем при следующем проходе
+        play_history.dirty = True
+        print(f"Ошибка сохранения истории: {e}")
+
+# Прогрев кэшей перед часами пик: за WARM_LEAD_MINUTES до начала часа заново извлекаются
+# треки, которые чаще всего играют в этот час, чтобы вечерний пик не платил за холодное извлечение
+WARM_INTERVAL = 300
+WARM_LEAD_MINUTES = 20
+WARM_TOP_K = 30
+WARM_GUILD_TOP_K = 5
+# Бюджет: не больше WARM_MAX_PER_MINUTE извлечений в минуту и по одному за раз,
+# а при перегрузке или активных пользовательских извлечениях прогрев ждет
+WARM_MAX_PER_MINUTE = 6
+WARM_BUSY_EXTRACTIONS = 2
+# Прогрев занимает не больше этой доли кэша треков, чтобы не вытеснять свежие пользовательские записи
+WARM_CACHE_SHARE = 0.5
+
+class CacheWarmer:
+    def __init__(self):
+        self.stats = {'warmed': 0, 'already_cached': 0, 'deferred': 0, 'failed': 0}
+        self.warmed_hour = None
+        self.task = None
+
+    def candidates(self, hour):
+        """Самые популярные в этот час треки в целом и любимые треки серверов, активных в этот час"""
+        entries = play_history.entries
+        popular = sorted(
+            (key for key, entry in entries.items() if entry['hours'][hour]),
+            key=lambda key: entries[key]['hours'][hour], reverse=True
+        )
+        chosen = popular[:WARM_TOP_K]
+
+        for guild, hours in play_history.guild_hours.items():
+            # Сервер активен в этот час, если играет тогда не меньше, чем в среднем за сутки
+            if not hours[hour] or hours[hour] < sum(hours) / 24:
+                continue
+            favourites = sorted(
+                (key for key, entry in entries.items() if guild in entry['guilds']),
+                key=lambda key: entries[key]['guilds'][guild], reverse=True
+            )
+            chosen.extend(key for key in favourites[:WARM_GUILD_TOP_K] if key not in chosen)
+        return chosen[:self.limit()]
+
+    def limit(self):
+        """Сколько треков прогревать: доля кэша и то, что успеет извлечься до начала часа"""
+        return min(int(track_cache.maxsize * WARM_CACHE_SHARE), WARM_LEAD_MINUTES * WARM_MAX_PER_MINUTE)
+
+    def busy(self):
+        return overload.level > 0 or len(pending_extractions) >= WARM_BUSY_EXTRACTIONS
+
+    async def warm(self, hour):
+        for key in self.candidates(hour):
+            entry = play_history.entries.get(key)
+            if entry is None:
+                continue
+            cache_key = await canonical_cache_key(entry['webpage_url'])
+            if cache_key.split('_', 1)[1] in track_cache:
+                self.stats['already_cached'] += 1
+                continue
+
+            while self.busy():
+                self.stats['deferred'] += 1
+                await asyncio.sleep(10)
+
+            info = await extract_info_async(entry['webpage_url'])
+            self.stats['warmed' if info else 'failed'] += 1
+            await asyncio.sleep(60 / WARM_MAX_PER_MINUTE)
+
+    def tick(self):
+        """Раз в час запускает прогрев для ближайшего часа"""
+        hour = (datetime.datetime.now() + datetime.timedelta(minutes=WARM_LEAD_MINUTES)).hour
+        if hour == self.warmed_hour or (self.task and not self.task.done()):
+            return
+        self.warmed_hour = hour
+        self.task = asyncio.create_task(self.warm(hour))
+
+    def report(self):
+        status = "идет" if self.task and not self.task.done() else "ожидает"
+        return (
+            f"Прогрев кэшей ({status}, последний час: {self.warmed_hour}): "
+            + " | ".join(f"{name}: {count}" for name, count in self.stats.items())
+        )
+
+cache_warmer = CacheWarmer()
+
+@tasks.loop(seconds=WARM_INTERVAL)
+async def warm_caches():
+    cache_warmer.tick()
+
+# Общий пул HTTP-соединений: проверка ссылок на потоки, ?radio и прямые ссылки на аудиофайлы
+HTTP_POOL_LIMIT = 50
+HTTP_POOL_PER_HOST = 8
+HTTP_KEEPALIVE = 30
+HTTP_PROBE_TIMEOUT = 5
+HTTP_MEDIA_READ_TIMEOUT = 30
+# Проверенная ссылка не проверяется повторно столько секунд
+HTTP_PROBE_FRESH = 300
+# Сколько треков в начале очереди проверять, когда начинается очередной трек
+HTTP_PROBE_AHEAD = 2
+# Прямые ссылки на файлы скачиваются через пул и подаются ffmpeg по stdin
+HTTP_MEDIA_PIPE = True
+# Типы содержимого, которые принимает ?radio (кроме любых audio/*)
+RADIO_CONTENT_TYPES = (
+    'application/ogg', 'application/octet-stream', 'application/x-mpegurl',
+    'application/vnd.apple.mpegurl', 'video/mp2t'
+)
+
+class HttpPool:
+    def __init__(self):
+        self.session = None
+        self.counters = {'connections': 0, 'reused': 0, 'probes': 0, 'dead': 0, 'errors': 0, 'media': 0}
+        self.latencies = deque(maxlen=200)
+
+    def start(self):
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_create)
+        trace.on_connection_reuseconn.append(self._on_reuse)
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT, limit_per_host=HTTP_POOL_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE, ttl_dns_cache=300
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, trace_configs=[trace],
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=HTTP_PROBE_TIMEOUT, sock_read=HTTP_MEDIA_READ_TIMEOUT)
+        )
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _on_create(self, session, context, params):
+        self.counters['connections'] += 1
+
+    async def _on_reuse(self, session, context, params):
+        self.counters['reused'] += 1
+
+    async def probe(self, url):
+        """HEAD-запрос, а если сервер его не принимает — запрос первого байта.
+        Возвращает статус, тип содержимого и задержку; None — сервер недоступен"""
+        self.counters['probes'] += 1
+        started = time.perf_counter()
+        timeout = aiohttp.ClientTimeout(total=HTTP_PROBE_TIMEOUT)
+        try:
+            async with self.session.head(url, allow_redirects=True, timeout=timeout) as response:
+                status, content_type = response.status, response.content_type
+            if status in (405, 501):
+                async with self.session.get(url, headers={'Range': 'bytes=0-0'}, timeout=timeout) as response:
+                    status, content_type = response.status, response.content_type
+                    # Дочитанный ответ возвращает соединение в пул; полный файл без Range не читаем
+                    if status == 206:
+                        await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.counters['errors'] += 1
+            print(f"Ошибка проверки {url[:80]}: {e or type(e).__name__}")
+            return None
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        if status >= 400:
+            self.counters['dead'] += 1
+        return {'status': status, 'content_type': content_type, 'latency': latency}
+
+    async def check_radio(self, url):
+        """Текст ошибки для ?radio или None, если по ссылке отдается звук"""
+        started = time.perf_counter()
+        try:
+            async with self.session.get(
+                url, headers={'Icy-MetaData': '0'}, timeout=aiohttp.ClientTimeout(total=HTTP_PROBE_TIMEOUT)
+            ) as response:
+                status, content_type = response.status, response.content_type
+        except aiohttp.ClientResponseError:
+            # Ответ "ICY 200 OK" старых серверов SHOUTcast aiohttp не разбирает, а ffmpeg понимает
+            return None
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.counters['errors'] += 1
+            return f"Сервер недоступен: {e or type(e).__name__}"
+        self.counters['probes'] += 1
+        self.latencies.append(time.perf_counter() - started)
+        if status >= 400:
+            return f"Сервер ответил кодом {status}"
+        if not content_type.startswith('audio/') and content_type not in RADIO_CONTENT_TYPES:
+            return f"По ссылке не аудиопоток (`{content_type}`)"
+        return None
+
+    async def open_media(self, url):
+        response = await self.session.get(url)
+        response.raise_for_status()
+        self.counters['media'] += 1
+        return response
+
+    def report(self):
+        created, reused = self.counters['connections'], self.counters['reused']
+        share = reused / (created + reused) * 100 if created + reused else 0
+        lines = [
+            f"Соединений: новых {created}, повторно использовано {reused} ({share:.0f}%) | "
+            + " | ".join(f"{name}: {count}" for name, count in self.counters.items() if name not in ('connections', 'reused'))
+        ]
+        samples = sorted(self.latencies)
+        if samples:
+            p50 = samples[len(samples) // 2]
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            lines.append(f"Задержка проверки: p50 {p50 * 1000:.0f} мс, p95 {p95 * 1000:.0f} мс ({len(samples)} замеров)")
+        return "\n".join(lines)
+
+http_pool = HttpPool()
+
+class HttpMediaStream:
+    """Файлоподобный HTTP-ответ из общего пула для stdin ffmpeg.
+    read() вызывается потоком записи discord.py, сетевой ввод-вывод идет в цикле событий"""
+
+    def __init__(self, url):
+        self.url = url
+        self.loop = bot.loop
+        self.response = None
+        self.closed = False
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout=HTTP_MEDIA_READ_TIMEOUT)
+
+    def read(self, size=-1):
+        if self.closed:
+            return b''
+        try:
+            if self.response is None:
+                self.response = self._run(http_pool.open_media(self.url))
+            return self._run(self.response.content.read(size))
+        except Exception as e:
+            print(f"Ошибка загрузки {self.url[:80]}: {e or type(e).__name__}")
+            self.close()
+            return b''
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Полностью прочитанный ответ возвращает соединение в пул
+        if self.response is not None:
+            self.loop.call_soon_threadsafe(self.response.release)
+
+def is_direct_media(url):
+    parsed = urlsplit(url)
+    return parsed.scheme in ('http', 'https') and parsed.path.lower().endswith(LIBRARY_EXTENSIONS)
+
+async def forget_stream(track):
+    """Ссылка на поток больше не работает: ни трек, ни кэши не должны ее отдавать"""
+    dead = track.get('url')
+    track['url'] = None
+    cache_key = await canonical_cache_key(track['webpage_url'])
+    search_cache.pop(cache_key, None)
+    track_cache.pop(cache_key.split('_', 1)[1], None)
+    for key, info in list(search_cache.items()):
+        entries = info.get('entries')
+        entry = entries[0] if entries else info
+        if entry and entry.get('url') == dead:
+            search_cache.pop(key, None)
+
+async def ensure_stream_alive(track, queue=None):
+    """Проверка ссылки на поток до воспроизведения; мертвая ссылка получается заново"""
+    url = track.get('url')
+    if not url or not url.startswith(('http://', 'https://')) or not track.get('webpage_url'):
+        return track
+    if time.time() - track.get('probed', 0) < HTTP_PROBE_FRESH:
+        return track
+    result = await http_pool.probe(url)
+    # Недоступный сервер — не повод заново извлекать трек: ffmpeg попробует сам
+    if result is None or result['status'] < 400:
+        track['probed'] = time.time()
+        return track
+    print(f"Ссылка на поток не работает ({result['status']}): {track['title']}")
+    await forget_stream(track)
+    return await resolve_track(track, queue)
+
+async def check_upcoming(state):
+    """Фоновая проверка ближайших треков очереди"""
+    if overload.level >= 2:
+        return
+    for track in list(state.queue[:HTTP_PROBE_AHEAD]):
+        try:
+            await ensure_stream_alive(track, state.queue)
+        except Exception as e:
+            print(f"Ошибка проверки трека: {e}")
+
+# Нормализация громкости: громкость трека измеряется один раз в фоне,
+# а при запуске следующих воспроизведений к нему применяется готовое усиление
+LOUDNESS_NORMALIZE = True
+METADATA_DB_PATH = os.path.join(DATA_DIR, 'metadata.sqlite3')
+# Целевая интегральная громкость (LUFS) и пределы усиления (дБ)
+LOUDNESS_TARGET = -14.0
+LOUDNESS_MAX_BOOST = 6.0
+LOUDNESS_MAX_CUT = 15.0
+# Сколько секунд трека анализировать; остальное мало меняет интегральную громкость
+LOUDNESS_ANALYZE_SECONDS = 300
+LOUDNESS_TIMEOUT = 120
+LOUDNESS_INTERVAL = 15
+LOUDNESS_QUEUE_MAX = 100
+LOUDNESS_RE = re.compile(r'"input_i"\s*:\s*"([^"]+)"')
+
+def loudness_key(track):
+    """Ключ замера: id видео для YouTube, путь для файла библиотеки"""
+    webpage_url = track.get('webpage_url') or ''
+    if webpage_url.startswith(LOCAL_PREFIX):
+        return webpage_url
+    key = youtube_media_key(webpage_url)
+    return key[1] if key else track.get('id')
+
+def measure_loudness(url):
+    """Интегральная громкость потока (LUFS) по первому проходу loudnorm; ffmpeg работает с низким приоритетом"""
+    # Приоритет понижает nice: preexec_fn небезопасен в процессе с потоками
+    args = ['nice', '-n', '19'] if os.name == 'posix' else []
+    args += ['ffmpeg', '-hide_banner', '-nostats', '-threads', '1']
+    if not os.path.isfile(url):
+        args += ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+    args += ['-t', str(LOUDNESS_ANALYZE_SECONDS), '-i', url, '-vn', '-sn', '-dn',
+             '-af', 'loudnorm=print_format=json', '-f', 'null', '-']
+    result = subprocess.run(
+        args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        timeout=LOUDNESS_TIMEOUT
+    )
+    match = LOUDNESS_RE.search(result.stderr.decode(errors='replace'))
+    if not match:
+        raise RuntimeError(f"ffmpeg не вернул громкость (код {result.returncode})")
+    return float(match.group(1))
+
+def loudness_gain_db(lufs):
+    return max(-LOUDNESS_MAX_CUT, min(LOUDNESS_MAX_BOOST, LOUDNESS_TARGET - lufs))
+
+def with_gain(options, gain):
+    """Опции ffmpeg с постоянным усилением: оно встраивается в уже имеющийся фильтр volume"""
+    if gain == 1.0:
+        return options
+    if 'volume=0.99' in options['options']:
+        return dict(options, options=options['options'].replace('volume=0.99', f'volume={0.99 * gain:.4f}'))
+    return dict(options, options=f"{options['options']} -filter:a \"volume={gain:.4f}\"")
+
+class LoudnessStore:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        # Все замеры держатся в памяти: усиление нужно синхронно, в момент запуска источника
+        self.gains = {}
+        self.pending = {}
+        self.stats = {'measured': 0, 'failed': 0, 'applied': 0, 'skipped': 0}
+        self.last_measure = None
+
+    def connect(self):
+        return sqlite3.connect(self.db_path, timeout=10)
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        conn = self.connect()
+        try:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS loudness '
+                '(track_key TEXT PRIMARY KEY, lufs REAL, gain_db REAL, measured REAL)'
+            )
+            self.gains = {key: gain_db for key, gain_db in conn.execute('SELECT track_key, gain_db FROM loudness')}
+        finally:
+            conn.close()
+
+    def store(self, key, lufs, gain_db):
+        conn = self.connect()
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO loudness (track_key, lufs, gain_db, measured) VALUES (?, ?, ?, ?)',
+                (key, lufs, gain_db, time.time())
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def gain(self, track):
+        """Множитель громкости для трека; 1.0, если замера еще нет"""
+        if not LOUDNESS_NORMALIZE or not track:
+            return 1.0
+        gain_db = self.gains.get(loudness_key(track))
+        if gain_db is None:
+            return 1.0
+        self.stats['applied'] += 1
+        return 10 ** (gain_db / 20)
+
+    def request(self, track):
+        """Трек начал играть: если замера нет, он встает в очередь фонового анализа"""
+        if not LOUDNESS_NORMALIZE or not track.get('url') or not track.get('duration'):
+            return
+        key = loudness_key(track)
+        if not key or key in self.gains or key in self.pending or len(self.pending) >= LOUDNESS_QUEUE_MAX:
+            return
+        self.pending[key] = track['url']
+
+    def measure(self, key, url):
+        """Замер одного трека; вызывается в пуле потоков"""
+        started = time.monotonic()
+        try:
+            lufs = measure_loudness(url)
+        except Exception as e:
+            self.stats['failed'] += 1
+            print(f"Ошибка замера громкости {key}: {e}")
+        else:
+            gain_db = loudness_gain_db(lufs)
+            # Замер применяется и без записи в базу, просто не переживет перезапуск
+            self.gains[key] = gain_db
+            try:
+                self.store(key, lufs, gain_db)
+            except sqlite3.Error as e:
+                self.stats['failed'] += 1
+                print(f"Ошибка сохранения громкости {key}: {e}")
+            else:
+                self.stats['measured'] += 1
+        self.last_measure = (time.time(), time.monotonic() - started)
+
+    def report(self):
+        lines = [
+            f"Замеров: {len(self.gains)}, в очереди: {len(self.pending)} | "
+            + " | ".join(f"{name}: {count}" for name, count in self.stats.items())
+        ]
+        if self.last_measure:
+            finished, seconds = self.last_measure
+            lines.append(f"Последний замер: {format_duration(time.time() - finished)} назад, за {seconds:.1f}с")
+        return "\n".join(lines)
+
+loudness = LoudnessStore(METADATA_DB_PATH)
+
+@tasks.loop(seconds=LOUDNESS_INTERVAL)
+async def measure_loudness_queue():
+    # Анализ необязателен: при любой перегрузке он ждет
+    if not loudness.pending or overload.level > 0:
+        if loudness.pending:
+            loudness.stats['skipped'] += 1
+        return
+    key, url = next(iter(loudness.pending.items()))
+    try:
+        await run_in_executor(loudness.measure, key, url)
+    finally:
+        loudness.pending.pop(key, None)
+
+async def reply(ctx, embed, message=None):
+    """Ответ на команду: правка сообщения о загрузке, если оно есть, иначе новое сообщение
+    (для слеш-команд после defer это одно сообщение-продолжение)"""
+    if message is not None:
+        return await message.edit(embed=embed)
+    return await ctx.send(embed=embed)
+
+async def add_to_queue(ctx, track, message=None):
     """Асинхронное добавление трека в очередь"""
     state = get_server_state(ctx.guild.id)
-    
+
     track['user'] = ctx.author
     state.queue.append(track)
+    mark_queue_dirty(state)
 
     # Отправляем мгновенный ответ
     embed = create_embed(
@@ -175,70 +2704,511 @@ async def add_to_queue(ctx, track):
         f"✅ **{track['title']}** (`{format_duration(track['duration'])}`)\nДобавил: {ctx.author.mention}"
     )
 
-    await ctx.send(embed=embed)
+    await reply(ctx, embed, message)
 
     # Если ничего не играет, запускаем воспроизведение
-    if not state.voice_client.is_playing() and not state.is_paused:
-        await play_next(ctx)
+    state.player.post('play', ctx)
+
+# Состояния проигрывателя сервера
+class PlayerStatus(enum.Enum):
+    IDLE = 'idle'
+    LOADING = 'loading'
+    PLAYING = 'playing'
+    PAUSED = 'paused'
+    SEEKING = 'seeking'
+
+# Трек, закончившийся быстрее, считается неудачным запуском (битая ссылка, ошибка ffmpeg)
+MIN_TRACK_SECONDS = 2
+# Задержка перед следующей попыткой растет вдвое после каждой неудачи подряд
+PLAYER_BACKOFF_BASE = 1
+PLAYER_BACKOFF_MAX = 60
+PLAYER_MAX_FAILURES = 8
+
+# Проигрыватель сервера: события обрабатывает одна задача строго по очереди,
+# поэтому ?skip, перемотка и конец трека не могут запустить два трека одновременно
+class GuildPlayer:
+    def __init__(self, state):
+        self.state = state
+        self.status = PlayerStatus.IDLE
+        self.events = deque()
+        self.task = None
+        self.ctx = None
+        # Номер текущего источника: события от остановленных источников игнорируются
+        self.generation = 0
+        self.failures = 0
+        self.started_at = 0
+        self.paused_position = 0
+        self.source_url = None
+        self.mixer = None
+        # Трек, декодер которого уже подготовлен в микшере
+        self.preloaded = None
+
+    def post(self, event, *args):
+        """Добавление события; потребитель запускается, если он еще не работает"""
+        self.events.append((event, args))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._consume())
+
+    async def _consume(self):
+        while self.events:
+            event, args = self.events.popleft()
+            try:
+                await getattr(self, f'_on_{event}')(*args)
+            except Exception as e:
+                print(f"Ошибка проигрывателя ({event}): {e}")
+                # Иначе проигрыватель так и остался бы в загрузке и не принял бы следующий ?play
+                if self.status in (PlayerStatus.LOADING, PlayerStatus.SEEKING):
+                    self.status = PlayerStatus.IDLE
+
+    def position(self):
+        if self.status is PlayerStatus.PAUSED:
+            return self.paused_position
+        return time.time() - self.state.start_time
+
+    def pause(self):
+        voice_client = self.state.voice_client
+        if self.status is not PlayerStatus.PLAYING or not voice_client or not voice_client.is_playing():
+            return False
+        voice_client.pause()
+        self.paused_position = self.position()
+        self.status = PlayerStatus.PAUSED
+        return True
+
+    def resume(self):
+        voice_client = self.state.voice_client
+        if self.status is not PlayerStatus.PAUSED or not voice_client:
+            return False
+        voice_client.resume()
+        self.state.start_time = time.time() - self.paused_position
+        self.status = PlayerStatus.PLAYING
+        return True
+
+    def _after(self, generation):
+        """after-колбэк для voice_client.play; вызывается из аудиопотока"""
+        def after_playing(error):
+            bot.loop.call_soon_threadsafe(self.post, 'track_end', generation, error)
+        return after_playing
+
+    def _mixer_after(self, mixer):
+        def after_mixing(error):
+            bot.loop.call_soon_threadsafe(self.post, 'mixer_closed', mixer, error)
+        return after_mixing
+
+    def _mixer_attached(self):
+        voice_client = self.state.voice_client
+        return (
+            self.mixer is not None and voice_client is not None and voice_client.source is self.mixer
+            and (voice_client.is_playing() or voice_client.is_paused())
+        )
 
-async def play_next(ctx):
-    state = get_server_state(ctx.guild.id)
+    def _halt(self):
+        self.generation += 1
+        voice_client = self.state.voice_client
+        self.preloaded = None
+        if self._mixer_attached() and voice_client.is_paused():
+            # На паузе аудиопоток не читает микшер и не применит команду: отключаем его,
+            # декодеры закроет сам аудиопоток после остановки
+            self.mixer = None
+            voice_client.stop()
+        elif self._mixer_attached():
+            # Микшер остается подключенным: следующий трек сменит в нем декодер
+            self.mixer.clear()
+        elif voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            voice_client.stop()
+
+    def _options(self, url, track):
+        options = overload.ffmpeg_options(local_ffmpeg_options if os.path.isfile(url) else None)
+        if not self.state.is_radio:
+            options = with_gain(options, loudness.gain(track))
+        return options
+
+    def _pcm_source(self, url, position, options):
+        if HTTP_MEDIA_PIPE and not position and is_direct_media(url):
+            # Файл по прямой ссылке качается через общий пул с keep-alive; ключи переподключения ffmpeg не нужны
+            options = dict(options, before_options=overload.ffmpeg_options(local_ffmpeg_options)['before_options'])
+            source = TrackedFFmpegPCMAudio(HttpMediaStream(url), guild_id=self.state.guild_id, pipe=True, **options)
+            return discord.PCMVolumeTransformer(source, volume=self.state.current_volume)
+        if position:
+            options = dict(options, before_options=f"{options['before_options']} -ss {position}")
+        source = TrackedFFmpegPCMAudio(url, guild_id=self.state.guild_id, **options)
+        return discord.PCMVolumeTransformer(source, volume=self.state.current_volume)
+
+    async def _start_source(self, url, position=0):
+        options = self._options(url, self.state.current)
+        self.source_url = url
+        voice_client = self.state.voice_client
+
+        source = await self._node_source(url, position, options, voice_client)
+        if voice_client is not self.state.voice_client:
+            # Пока шло подключение к узлу, бот вышел из голосового канала
+            if source is not None:
+                source.cleanup()
+            raise discord.ClientException("Голосовое соединение потеряно")
+        if source is None and MIXER_ENABLED and not self.state.is_radio:
+            return self._start_mixer(url, position, options, voice_client)
+        if source is None:
+            source = self._pcm_source(url, position, options)
+        # Кадры аудиоузла уже закодированы и в микшер не попадают
+        if self._mixer_attached():
+            self.mixer = None
+            voice_client.stop()
+        self.generation += 1
+        voice_client.play(source, after=self._after(self.generation), bitrate=channel_bitrate(voice_client.channel))
+        self._started(voice_client, position)
+
+    def _start_mixer(self, url, position, options, voice_client):
+        self.generation += 1
+        self.preloaded = None
+        deck = MixerDeck(self._pcm_source(url, position, options), self.generation, self.state.current, position)
+        if self._mixer_attached():
+            self.mixer.play(deck)
+            if voice_client.is_paused():
+                voice_client.resume()
+        else:
+            if voice_client.is_playing() or voice_client.is_paused():
+                voice_client.stop()
+            self.mixer = MixerSource(self, self.state.current_volume)
+            self.mixer.play(deck)
+            voice_client.play(self.mixer, after=self._mixer_after(self.mixer), bitrate=channel_bitrate(voice_client.channel))
+        self._started(voice_client, position)
+        self._schedule_preload(position)
+
+    def _started(self, voice_client, position):
+        configure_encoder(voice_client, self.state.guild_id)
+        self.started_at = time.monotonic()
+        self.state.start_time = time.time() - position
+        self.status = PlayerStatus.PLAYING
+
+    def _schedule_preload(self, position):
+        """Декодер следующего трека запускается заранее, чтобы микшер сменил трек без паузы"""
+        duration = (self.state.current or {}).get('duration') or 0
+        if duration:
+            delay = max(0, duration - position - MIXER_PRELOAD_SECONDS - crossfade_seconds())
+            bot.loop.call_later(delay, self.post, 'preload', self.generation)
+
+    async def _node_source(self, url, position, options, voice_client):
+        """Поток с наименее загруженного аудиоузла; None — играть в процессе бота"""
+        node = node_pool.pick()
+        if node is None:
+            return None
+        kbps = channel_bitrate(voice_client.channel)
+        # Подключение к узлу идет в пуле потоков: зависший узел не должен останавливать цикл событий
+        try:
+            return await run_in_executor(functools.partial(
+                NodeAudioSource, node, url, position=position, volume=self.state.current_volume,
+                bitrate=kbps, complexity=opus_complexity(kbps), **options
+            ))
+        except OSError as e:
+            node_pool.mark_failed(node, e)
+            return None
 
-    if state.nowplaying_updater:
-        state.nowplaying_updater.cancel()
-        state.nowplaying_updater = None
+    def prefetch_autoplay(self):
+        """Подбор и получение ссылки на следующий трек заранее, пока текущий еще играет"""
+        state = self.state
+        if not state.autoplay or state.queue or not state.current or state.is_radio:
+            return
+        seed = state.current.get('id')
+        if state.autoplay_seed == seed and state.autoplay_task:
+            return
+        state.autoplay_seed = seed
+        state.autoplay_task = asyncio.create_task(self._find_autoplay_track(state.current))
 
-    if state.is_paused or state.is_seeking:
-        return
+    async def _find_autoplay_track(self, seed):
+        state = self.state
+        try:
+            for record in await autoplay_candidates(seed):
+                if record['id'] in state.recent_set:
+                    continue
+                track = track_from_record(record)
+                if await resolve_track(track):
+                    return track
+        except Exception as e:
+            print(f"Ошибка автовоспроизведения: {e}")
+        return None
 
-    # Получаем следующий трек из очереди
-    if state.is_looping and state.current:
-        track = state.current
-    elif state.queue:
-        track = state.queue.pop(0)
-    else:
+    async def _autoplay_track(self, previous):
+        """Следующий трек автовоспроизведения: подготовленный заранее или подобранный сейчас"""
+        state = self.state
+        task = state.autoplay_task
+        state.autoplay_task = None
+        if task is None or state.autoplay_seed != (previous or {}).get('id'):
+            if task:
+                task.cancel()
+            if not previous:
+                return None
+            task = asyncio.create_task(self._find_autoplay_track(previous))
+        return await task
+
+    async def _on_play(self, ctx):
+        self.ctx = ctx
+        if self.status is PlayerStatus.IDLE:
+            await self._start_next()
+
+    async def _on_track_end(self, generation, error):
+        if generation != self.generation:
+            return
+        if isinstance(error, AudioNodeError) and self.state.voice_client:
+            # Аудиоузел упал посреди трека: продолжаем с той же позиции на другом узле или локально
+            position = self.position() if self.state.current else 0
+            try:
+                return await self._start_source(self.source_url, position)
+            except Exception as e:
+                error = e
+        if error:
+            print(f"Ошибка воспроизведения: {error}")
+        if time.monotonic() - self.started_at < MIN_TRACK_SECONDS:
+            self.failures += 1
+        else:
+            self.failures = 0
+        await self._advance()
+
+    def _next_candidate(self):
+        state = self.state
+        if state.is_looping and state.current:
+            return state.current
+        return state.queue[0] if state.queue else None
+
+    def queue_changed(self):
+        """Очередь или повтор изменились: подготовленный в микшере трек может быть уже не следующим"""
+        if self.preloaded is None or self._next_candidate() is self.preloaded:
+            return
+        self.preloaded = None
+        if self._mixer_attached():
+            self.mixer.queue_next(None)
+            # Таймер подготовки уже сработал: нового кандидата готовим сразу
+            self.post('preload', self.generation)
+
+    async def _on_preload(self, generation):
+        if generation != self.generation or self.status is not PlayerStatus.PLAYING or not self._mixer_attached():
+            return
+        track = self._next_candidate()
+        if track is None or track is self.preloaded:
+            return
+        if not track.get('url') and not await resolve_track(track, self.state.queue):
+            return
+        if not await ensure_stream_alive(track, self.state.queue):
+            return
+        # Пока шла загрузка, могли пропустить трек или поменять очередь
+        if generation != self.generation or not self._mixer_attached() or self._next_candidate() is not track:
+            return
+        try:
+            source = self._pcm_source(track['url'], 0, self._options(track['url'], track))
+        except Exception as e:
+            # Не вышло заранее — трек запустится обычным путем после окончания текущего
+            print(f"Ошибка подготовки следующего трека: {e}")
+            return
+        self.preloaded = track
+        self.mixer.queue_next(MixerDeck(source, generation + 1, track))
+
+    async def _on_mixer_switch(self, deck):
+        """Микшер перешел к подготовленному треку. Трек мог уже и закончиться
+        (например, ffmpeg не запустился): событие track_end для него придет следом"""
+        state = self.state
+        if self.mixer is None or deck.generation != self.generation + 1:
+            return
+        if self.mixer.current is not deck and not deck.finished:
+            return
+        self.preloaded = None
+        previous = state.current
+        track = deck.track
+        if track is not previous:
+            for index, queued in enumerate(state.queue):
+                if queued is track:
+                    state.queue.pop(index)
+                    break
+        if state.nowplaying_updater:
+            state.nowplaying_updater.cancel()
+            state.nowplaying_updater = None
+
+        self.generation = deck.generation
+        self.failures = 0
+        state.current = track
+        self.source_url = track['url']
+        self.started_at = time.monotonic()
+        state.start_time = time.time()
+        self.status = PlayerStatus.PLAYING
+        self._schedule_preload(0)
+        await self._announce(track, previous, 0)
+
+    async def _on_mixer_closed(self, mixer, error):
+        if self.mixer is not mixer:
+            return
+        self.mixer = None
+        if any(deck for _, deck in mixer.commands) and self.state.current and self.state.voice_client:
+            # Команда пришла в последний кадр ожидания: запускаем трек заново, уже с новым микшером
+            try:
+                return await self._start_source(self.source_url, self.position())
+            except Exception as e:
+                error = e
+        if self.status is PlayerStatus.PLAYING:
+            await self._on_track_end(self.generation, error)
+
+    async def _on_retry(self, generation):
+        if generation == self.generation and self.status is PlayerStatus.LOADING:
+            await self._start_next()
+
+    async def _on_skip(self):
+        if self.status in (PlayerStatus.PLAYING, PlayerStatus.PAUSED, PlayerStatus.LOADING):
+            self._halt()
+            self.failures = 0
+            await self._start_next()
+
+    async def _on_seek(self, position):
+        state = self.state
+        if self.status is not PlayerStatus.PLAYING or not state.current:
+            return
+        self._halt()
+        self.status = PlayerStatus.SEEKING
+        try:
+            await self._start_source(state.current['url'], position)
+        except Exception as e:
+            print(f"Ошибка перемотки: {e}")
+            self.failures += 1
+            await self._advance()
+
+    async def _on_stop(self):
+        self._halt()
+        self.status = PlayerStatus.IDLE
+        self.failures = 0
+        self.state.current = None
+
+    async def _on_radio(self, ctx, url):
+        self.ctx = ctx
+        self._halt()
+        try:
+            await self._start_source(url)
+        except Exception as e:
+            self.status = PlayerStatus.IDLE
+            self.state.is_radio = False
+            return await ctx.send(embed=create_embed("Ошибка", f"Не удалось воспроизвести радио: {e}"))
+        await ctx.send(embed=create_embed("Радио", f"📻 {url}"))
+
+    async def _advance(self):
+        """Переход к следующему треку; после неудач подряд — с растущей задержкой"""
+        if self.failures >= PLAYER_MAX_FAILURES:
+            await self._give_up()
+        elif self.failures:
+            self.status = PlayerStatus.LOADING
+            delay = min(PLAYER_BACKOFF_MAX, PLAYER_BACKOFF_BASE * 2 ** (self.failures - 1))
+            bot.loop.call_later(delay, self.post, 'retry', self.generation)
+        else:
+            await self._start_next()
+
+    async def _give_up(self):
+        state = self.state
+        self.failures = 0
+        self.status = PlayerStatus.IDLE
         state.current = None
         state.is_radio = False
-        await ctx.send(embed=create_embed("Очередь пуста", "Музыка остановлена."))
-        return
+        mark_queue_dirty(state)
+        voice_manager.release(state.guild_id)
+        await self.ctx.channel.send(embed=create_embed(
+            "Ошибка",
+            f"Не удалось воспроизвести {PLAYER_MAX_FAILURES} треков подряд, воспроизведение остановлено."
+        ))
 
-    state.current = track
-    url = track['url']
-    title = track['title']
-    user = track['user']
-    duration = track.get('duration', 0)
-    state.start_time = time.time()
-
-    if not (state.is_looping and state.last_playing_message):
-        progress_bar = create_progress_bar(0, duration)
-        description = (
-            f"🎵 **{title}**\n"
-            f"{progress_bar}\n"
-            f"`00:00 / {format_duration(duration)}`\n"
-            f"Добавил: {user.mention}"
-        )
-        state.last_playing_message = await ctx.send(embed=create_embed("Сейчас играет", description))
+    async def _start_next(self):
+        state = self.state
+        ctx = self.ctx
 
-        if not state.nowplaying_updater:
-            state.nowplaying_updater = asyncio.create_task(update_now_playing(ctx, state.last_playing_message, state))
+        if state.nowplaying_updater:
+            state.nowplaying_updater.cancel()
+            state.nowplaying_updater = None
 
-    def after_playing(e):
-        if not state.is_seeking and state.voice_client and state.voice_client.is_connected():
-            asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+        if not state.voice_client:
+            self.status = PlayerStatus.IDLE
+            return
 
-    try:
-        source = discord.FFmpegPCMAudio(url, **ffmpeg_options)
-        source = discord.PCMVolumeTransformer(source, volume=state.current_volume)
-        if state.voice_client:
-            state.voice_client.play(source, after=after_playing)
-    except Exception as e:
-        print(f"Ошибка воспроизведения: {e}")
-        asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+        # Получаем следующий трек из очереди
+        previous = state.current
+        track = None
+        from_queue = False
+        if state.is_looping and state.current:
+            track = state.current
+        elif state.queue:
+            track = state.queue.pop(0)
+            from_queue = True
+        elif state.autoplay and not state.is_radio:
+            self.status = PlayerStatus.LOADING
+            track = await self._autoplay_track(previous)
+
+        if track is None:
+            self.status = PlayerStatus.IDLE
+            state.current = None
+            state.is_radio = False
+            mark_queue_dirty(state)
+            voice_manager.release(state.guild_id)
+            await ctx.channel.send(embed=create_embed("Очередь пуста", "Музыка остановлена."))
+            return
+
+        self.status = PlayerStatus.LOADING
+
+        # Треки из ?search получают ссылку на поток только перед воспроизведением
+        try:
+            resolved = track.get('url') or await resolve_track(track)
+        except Exception:
+            if from_queue:
+                state.queue.insert(0, track)
+            raise
+        if not resolved:
+            await ctx.channel.send(embed=create_embed("Ошибка", f"Не удалось получить трек: {track['title']}"))
+            self.failures += 1
+            return await self._advance()
+
+        if not state.voice_client:
+            # Бот вышел из канала, пока трек загружался: трек остается первым в очереди
+            if from_queue:
+                state.queue.insert(0, track)
+                mark_queue_dirty(state)
+            self.status = PlayerStatus.IDLE
+            return
+
+        state.current = track
+        # Восстановленный после перезапуска трек продолжается с сохраненной позиции
+        start_at = track.pop('start_at', 0)
+        try:
+            await self._start_source(track['url'], start_at)
+        except Exception as e:
+            print(f"Ошибка воспроизведения: {e}")
+            self.failures += 1
+            return await self._advance()
+        await self._announce(track, previous, start_at)
+
+    async def _announce(self, track, previous, start_at):
+        """Учет начавшегося трека и сообщение «Сейчас играет»"""
+        state = self.state
+        ctx = self.ctx
+        mark_queue_dirty(state)
+        if track is not previous:
+            play_history.count_play(track, state.guild_id)
+            state.remember_played(track.get('id'))
+            loudness.request(track)
+        self.prefetch_autoplay()
+        asyncio.create_task(check_upcoming(state))
+
+        duration = track.get('duration', 0)
+        if not (state.is_looping and state.last_playing_message):
+            progress_bar = create_progress_bar(start_at, duration)
+            description = (
+                f"🎵 **{track['title']}**\n"
+                f"{progress_bar}\n"
+                f"`{format_duration(start_at)} / {format_duration(duration)}`\n"
+                f"Добавил: {requester_mention(track)}"
+            )
+            state.last_playing_message = await ctx.channel.send(embed=create_embed("Сейчас играет", description))
+
+            if not state.nowplaying_updater:
+                state.nowplaying_updater = asyncio.create_task(update_now_playing(ctx, state.last_playing_message, state))
 
 async def update_now_playing(ctx, message, state):
     while state.current and state.voice_client and (state.voice_client.is_playing() or state.voice_client.is_paused()):
         try:
-            position = time.time() - state.start_time if not state.is_paused else state.current.get('position', 0)
+            # Под нагрузкой прогресс-бар не обновляется
+            if overload.shed_progress():
+                await asyncio.sleep(15)
+                continue
+
+            position = state.player.position()
             duration = state.current.get('duration', 0)
 
             progress_bar = create_progress_bar(position, duration)
@@ -246,7 +3216,7 @@ async def update_now_playing(ctx, message, state):
                 f"🎵 **{state.current['title']}**\n"
                 f"{progress_bar}\n"
                 f"`{format_duration(position)} / {format_duration(duration)}`\n"
-                f"Добавил: {state.current['user'].mention}"
+                f"Добавил: {requester_mention(state.current)}"
             )
 
             await message.edit(embed=create_embed("Сейчас играет", description))
@@ -269,21 +3239,20 @@ async def add_playlist(ctx, search):
         ))
 
     try:
-        info = await run_in_executor(extract_info_sync, search, True)
+        # Ссылки на потоки треков плейлиста получаются только перед воспроизведением
+        records = await get_playlist_records(search)
 
-        if not info or 'entries' not in info or not info['entries']:
+        if not records:
             return await ctx.send(embed=create_embed("Ошибка", "Плейлист не найден или пуст"))
 
         tracks = []
-        for entry in info['entries']:
-            if not entry:
-                continue
-            track = process_track(entry)
+        for record in records:
+            track = track_from_record(record)
             track['user'] = ctx.author
             tracks.append(track)
 
-        for track in tracks:
-            state.queue.append(track)
+        state.queue.extend(tracks)
+        mark_queue_dirty(state)
 
         await ctx.send(embed=create_embed(
             "Плейлист добавлен",
@@ -292,30 +3261,82 @@ async def add_playlist(ctx, search):
             f"Добавил: {ctx.author.mention}"
         ))
 
-        if not state.voice_client.is_playing() and not state.is_paused:
-            await play_next(ctx)
+        state.player.post('play', ctx)
 
     except Exception as e:
         await ctx.send(embed=create_embed("Ошибка", f"Не удалось загрузить плейлист: {e}"))
 
 # События бота
+@bot.event
+async def setup_hook():
+    startup_timings['вход'] = time.perf_counter() - STARTUP_STARTED
+    warmup = start_ytdl_warmup()
+    if STARTUP_MODE == 'eager':
+        await warmup
+
+    saved_queue_guilds.update(await run_in_executor(list_saved_queues))
+    await run_in_executor(play_history.load)
+    http_pool.start()
+    await run_in_executor(loudness.load)
+    measure_loudness_queue.start()
+    save_play_history.start()
+    warm_caches.start()
+    evict_idle_states.start()
+    snapshot_playing_queues.start()
+    reap_ffmpeg_processes.start()
+    loop_monitor.start()
+    check_overload.start()
+    if library is not None:
+        rescan_library.start()
+
+# Пул HTTP закрывается вместе с ботом
+_close_bot = bot.close
+
+async def close_bot():
+    await http_pool.close()
+    await _close_bot()
+
+bot.close = close_bot
+
+def format_startup_timings():
+    return ", ".join(f"{phase} {seconds:.2f}с" for phase, seconds in startup_timings.items())
+
 @bot.event
 async def on_ready():
     activity = discord.Activity(type=discord.ActivityType.listening, name="?help")
     await bot.change_presence(status=discord.Status.idle, activity=activity)
     print(f"Бот запущен как {bot.user}")
+    # on_ready повторяется после переподключений, а этапы запуска фиксируются один раз
+    if 'шлюз' not in startup_timings:
+        startup_timings['шлюз'] = time.perf_counter() - STARTUP_STARTED
+        print(f"Запуск ({STARTUP_MODE}): {format_startup_timings()}")
 
 @bot.event
 async def on_guild_remove(guild):
     """Очистка состояния при выходе с сервера"""
     if guild.id in server_states:
-        state = server_states[guild.id]
-        if state.voice_client and state.voice_client.is_connected():
-            await state.voice_client.disconnect()
+        await voice_manager.disconnect(guild.id)
         del server_states[guild.id]
 
+@bot.event
+async def on_voice_state_update(member, before, after):
+    """Бота отключили извне: забываем мертвое соединение;
+    бота перенесли в другой канал: подстраиваем кодировщик под его битрейт"""
+    if member.id != bot.user.id:
+        return
+    if after.channel is not None:
+        state = server_states.get(member.guild.id)
+        if state and state.voice_client and before.channel != after.channel:
+            configure_encoder(state.voice_client, member.guild.id, after.channel)
+        return
+    encoder_settings.pop(member.guild.id, None)
+    state = server_states.get(member.guild.id)
+    if state and state.voice_client and not state.voice_client.is_connected():
+        voice_manager.cancel_idle(member.guild.id)
+        state.voice_client = None
+
 # Команды бота
-@bot.command()
+@bot.hybrid_command(description="Информация о боте")
 async def about(ctx):
     await ctx.send(embed=create_embed(
         "О боте",
@@ -324,16 +3345,20 @@ async def about(ctx):
         "обеспечивая полноценное музыкальное сопровождение для сервера.\n  \n**Сделано в ВФ**"
     ))
 
-@bot.command()
+@bot.hybrid_command(description="Проверить задержку бота")
 async def ping(ctx):
     latency = round(bot.latency * 1000)
     await ctx.send(embed=create_embed("Пинг", f"📡 {latency}ms"))
 
-@bot.command()
+@bot.hybrid_command(description="Воспроизвести трек")
 async def play(ctx, *, search: str):
     state = get_server_state(ctx.guild.id)
+    await ctx.defer()
+
+    # Несколько запросов или ссылок через перевод строки или ";" добавляются одной командой
+    queries = [query.strip() for query in re.split(r'[\n;]', search) if query.strip()]
 
-    if is_valid_url(search) and is_playlist_url(search):
+    if len(queries) == 1 and is_valid_url(search) and is_playlist_url(search):
         return await ctx.send(embed=create_embed(
             "Ошибка",
             "Похоже, вы ввели ссылку на плейлист. Для плейлистов используйте команду `?playlist`."
@@ -345,42 +3370,101 @@ async def play(ctx, *, search: str):
             "Сейчас играет радио. Остановите радио командой `?stop`, чтобы добавить треки в очередь."
         ))
 
-    state.is_paused = False
-
     if not ctx.author.voice:
         return await ctx.send(embed=create_embed("Ошибка", "Вы должны находиться в голосовом канале."))
 
     try:
-        if not state.voice_client or not state.voice_client.is_connected():
-            state.voice_client = await ctx.author.voice.channel.connect()
-        elif state.voice_client.channel != ctx.author.voice.channel:
-            await state.voice_client.move_to(ctx.author.voice.channel)
+        await voice_manager.ensure_connected(ctx)
     except Exception as e:
         return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
 
-    # Отправляем сообщение о начале загрузки
-    loading_msg = await ctx.send(embed=create_embed("Загрузка", "⏳ Получение информации о треке..."))
+    if len(queries) > 1:
+        return await play_many(ctx, queries[:PLAY_MAX_QUERIES])
+
+    # Сообщение о загрузке нужно только префиксной команде: слеш-команда уже показывает "думает..."
+    loading_msg = None
+    if ctx.interaction is None:
+        loading_msg = await ctx.send(embed=create_embed("Загрузка", "⏳ Получение информации о треке..."))
 
     try:
-        # Используем асинхронное извлечение информации
-        info = await extract_info_async(search, False)
+        track = await resolve_query(search)
 
-        if not info:
-            await loading_msg.edit(embed=create_embed("Ошибка", "Трек не найден."))
+        if track is None:
+            await reply(ctx, create_embed("Ошибка", "Трек не найден."), loading_msg)
             return
 
-        track = process_track(info)
-
-        # Удаляем сообщение о загрузке и добавляем трек в очередь
-        await loading_msg.delete()
-        await add_to_queue(ctx, track)
+        # Сообщение о загрузке становится подтверждением добавления
+        await add_to_queue(ctx, track, loading_msg)
 
     except Exception as e:
-        await loading_msg.edit(embed=create_embed("Ошибка", f"Не удалось получить трек: {e}"))
+        await reply(ctx, create_embed("Ошибка", f"Не удалось получить трек: {e}"), loading_msg)
+
+# Сколько запросов можно передать в один ?play
+PLAY_MAX_QUERIES = 10
 
-@bot.command()
+async def resolve_query(search):
+    """Трек по запросу или ссылке: локальная библиотека, история воспроизведения, затем yt-dlp"""
+    query = search if not is_valid_url(search) else None
+    track = await search_library(query) if query else None
+    if track is None and query:
+        track = play_history.match(query)
+
+    if track is None:
+        # Используем асинхронное извлечение информации
+        info = await extract_info_async(search)
+        if not info:
+            return None
+        track = process_track(info)
+        play_history.record(track, query)
+    return track
+
+async def play_many(ctx, queries):
+    """Несколько треков одной командой: извлекаются параллельно, а в очередь встают в исходном порядке,
+    как только готовы все предыдущие; итог — одним сообщением"""
+    state = get_server_state(ctx.guild.id)
+    loading_msg = None
+    if ctx.interaction is None:
+        loading_msg = await ctx.send(embed=create_embed("Загрузка", f"⏳ Получение информации о {len(queries)} треках..."))
+
+    # Ссылки на плейлисты здесь не принимаются, как и в одиночном ?play
+    pending = [
+        None if is_valid_url(query) and is_playlist_url(query) else asyncio.ensure_future(resolve_query(query))
+        for query in queries
+    ]
+    added, failed = [], []
+    for query, task in zip(queries, pending):
+        track = None
+        if task is not None:
+            try:
+                track = await task
+            except Exception as e:
+                print(f"Ошибка извлечения информации: {e}")
+        if track is None:
+            failed.append(query)
+            continue
+
+        track['user'] = ctx.author
+        state.queue.append(track)
+        added.append(track)
+        # Первый трек начинает играть, пока остальные еще извлекаются
+        if len(added) == 1:
+            state.player.post('play', ctx)
+
+    if not added:
+        return await reply(ctx, create_embed("Ошибка", "Ни один трек не найден."), loading_msg)
+    mark_queue_dirty(state)
+
+    lines = [f"✅ Добавлено треков: {len(added)} из {len(queries)} (`{format_duration(sum(track.get('duration') or 0 for track in added))}`)"]
+    lines.extend(f"**{i}.** {track['title']} (`{format_duration(track.get('duration') or 0)}`)" for i, track in enumerate(added, start=1))
+    if failed:
+        lines.append("❌ Не найдено: " + ", ".join(f"`{query[:60]}`" for query in failed))
+    lines.append(f"Добавил: {ctx.author.mention}")
+    await reply(ctx, create_embed("Добавлено в очередь", "\n".join(lines)), loading_msg)
+
+@bot.hybrid_command(description="Воспроизвести плейлист")
 async def playlist(ctx, *, search: str):
     state = get_server_state(ctx.guild.id)
+    await ctx.defer()
 
     # Если это URL, но не плейлист — сразу ошибка
     if is_valid_url(search) and not is_playlist_url(search):
@@ -396,6 +3480,12 @@ async def playlist(ctx, *, search: str):
             "Вы ввели текст, а не ссылку на плейлист. Используйте `?play` для поиска треков."
         ))
 
+    if not overload.accept_playlist():
+        return await ctx.send(embed=create_embed(
+            "Бот перегружен",
+            "Сейчас бот не принимает новые плейлисты. Попробуйте немного позже."
+        ))
+
     # Если играет радио — ошибка
     if state.is_radio:
         return await ctx.send(embed=create_embed(
@@ -409,20 +3499,19 @@ async def playlist(ctx, *, search: str):
 
     # Подключение к голосовому каналу
     try:
-        if not state.voice_client or not state.voice_client.is_connected():
-            state.voice_client = await ctx.author.voice.channel.connect()
-        elif state.voice_client.channel != ctx.author.voice.channel:
-            await state.voice_client.move_to(ctx.author.voice.channel)
+        await voice_manager.ensure_connected(ctx)
     except Exception as e:
         return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
 
     # Если это действительно плейлист — загружаем
+    if ctx.interaction is not None:
+        return await add_playlist(ctx, search)
     await ctx.send(embed=create_embed("Загрузка плейлиста", "⏳ Пожалуйста, подождите, плейлист загружается..."))
     bot.loop.create_task(add_playlist(ctx, search))
 
-@bot.command()
+@bot.hybrid_command(description="Показать текущий трек с прогресс-баром")
 async def nowplaying(ctx):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
 
     try:
         await ctx.message.delete()
@@ -434,166 +3523,192 @@ async def nowplaying(ctx):
 
     if state.last_playing_message:
         try:
-            position = time.time() - state.start_time if not state.is_paused else state.current.get('position', 0)
+            position = state.player.position()
             duration = state.current.get('duration', 0)
             progress_bar = create_progress_bar(position, duration)
             description = (
                 f"🎵 **{state.current['title']}**\n"
                 f"{progress_bar}\n"
                 f"`{format_duration(position)} / {format_duration(duration)}`\n"
-                f"Добавил: {state.current['user'].mention}"
+                f"Добавил: {requester_mention(state.current)}"
             )
             await state.last_playing_message.edit(embed=create_embed("Сейчас играет", description))
+            if ctx.interaction is not None:
+                await ctx.send(embed=create_embed("Сейчас играет", description), ephemeral=True)
             return
         except:
             pass
 
-    position = time.time() - state.start_time if not state.is_paused else state.current.get('position', 0)
+    position = state.player.position()
     duration = state.current.get('duration', 0)
     progress_bar = create_progress_bar(position, duration)
     description = (
         f"🎵 **{state.current['title']}**\n"
         f"{progress_bar}\n"
         f"`{format_duration(position)} / {format_duration(duration)}`\n"
-        f"Добавил: {state.current['user'].mention}"
+        f"Добавил: {requester_mention(state.current)}"
     )
     state.last_playing_message = await ctx.send(embed=create_embed("Сейчас играет", description))
 
     if not state.nowplaying_updater and state.voice_client and (state.voice_client.is_playing() or state.voice_client.is_paused()):
         state.nowplaying_updater = bot.loop.create_task(update_now_playing(ctx, state.last_playing_message, state))
 
-@bot.command(name='queue')
+def queue_page_embed(queue, page):
+    header = (
+        f"Текущая очередь | {len(queue)} треков | {format_duration(queue.total_duration)} | "
+        f"Страница {page}/{queue.page_count()}"
+    )
+    return create_embed(header, queue.render_page(page), color=0xB0C4DE)
+
+# Кнопки листания ?queue: одно редактирование сообщения на каждое нажатие
+class QueueView(discord.ui.View):
+    def __init__(self, author, queue, page):
+        super().__init__(timeout=60.0)
+        self.author = author
+        self.queue = queue
+        self.page = page
+        self.message = None
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author.id
+
+    async def show(self, interaction, page):
+        self.page = max(1, min(page, self.queue.page_count()))
+        await interaction.response.edit_message(embed=queue_page_embed(self.queue, self.page), view=self)
+
+    @discord.ui.button(emoji="⬅️", style=discord.ButtonStyle.secondary)
+    async def previous(self, interaction, button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="➡️", style=discord.ButtonStyle.secondary)
+    async def next(self, interaction, button):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(emoji="❌", style=discord.ButtonStyle.danger)
+    async def close(self, interaction, button):
+        self.stop()
+        await interaction.response.defer()
+        await interaction.message.delete()
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+@bot.hybrid_command(name='queue', description="Показать очередь воспроизведения")
 async def queue_(ctx, page: int = 1):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
     if not state.queue:
         return await ctx.send(embed=create_embed("Очередь пуста"))
 
-    items_per_page = 10
-    total_pages = max(1, (len(state.queue) + items_per_page - 1) // items_per_page)
-    page = max(1, min(page, total_pages))
+    page = max(1, min(page, state.queue.page_count()))
+    if state.queue.page_count() == 1:
+        return await ctx.send(embed=queue_page_embed(state.queue, page))
 
-    start = (page - 1) * items_per_page
-    end = start + items_per_page
-    lines = []
-    for i, song in enumerate(state.queue[start:end], start=start + 1):
-        duration = format_duration(song.get('duration', 0))
-        lines.append(f"**{i}.** [`{duration}`] {song['title']} - {song['user'].mention}")
-
-    total_duration = sum(song.get('duration', 0) for song in state.queue)
-    header = f"Текущая очередь | {len(state.queue)} треков | {format_duration(total_duration)} | Страница {page}/{total_pages}"
-    message = await ctx.send(embed=create_embed(header, "\n".join(lines), color=0xB0C4DE))
-
-    if total_pages > 1:
-        await message.add_reaction("⬅️")
-        await message.add_reaction("➡️")
-        await message.add_reaction("❌")
-
-        def check(reaction, user):
-            return user == ctx.author and str(reaction.emoji) in ["⬅️", "➡️", "❌"] and reaction.message.id == message.id
-
-        try:
-            while True:
-                reaction, user = await bot.wait_for('reaction_add', timeout=60.0, check=check)
-
-                if str(reaction.emoji) == "❌":
-                    await message.delete()
-                    return
-                elif str(reaction.emoji) == "⬅️":
-                    page = max(1, page - 1)
-                elif str(reaction.emoji) == "➡️":
-                    page = min(total_pages, page + 1)
-
-                start = (page - 1) * items_per_page
-                end = start + items_per_page
-                lines = []
-                for i, song in enumerate(state.queue[start:end], start=start + 1):
-                    duration = format_duration(song.get('duration', 0))
-                    lines.append(f"**{i}.** [`{duration}`] {song['title']} - {song['user'].mention}")
-
-                header = f"Текущая очередь | {len(state.queue)} треков | {format_duration(total_duration)} | Страница {page}/{total_pages}"
-                embed = create_embed(header, "\n".join(lines), color=0xB0C4DE)
-                await message.edit(embed=embed)
-                await message.remove_reaction(reaction, user)
-
-        except asyncio.TimeoutError:
-            await message.clear_reactions()
-
-@bot.command()
+    view = QueueView(ctx.author, state.queue, page)
+    view.message = await ctx.send(embed=queue_page_embed(state.queue, page), view=view)
+
+@bot.hybrid_command(description="Удалить трек из очереди")
 async def remove(ctx, arg: str):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
     if not state.queue:
         return await ctx.send(embed=create_embed("Очередь пуста"))
     if arg == 'all':
         state.queue.clear()
+        mark_queue_dirty(state)
         await ctx.send(embed=create_embed("Очищено", "Очередь была полностью очищена."))
     else:
         try:
             index = int(arg) - 1
             if 0 <= index < len(state.queue):
                 removed = state.queue.pop(index)
+                mark_queue_dirty(state)
                 await ctx.send(embed=create_embed("Удалено", f"🗑️ {removed['title']}"))
             else:
                 await ctx.send(embed=create_embed("Ошибка", "Неверный индекс!"))
         except ValueError:
             await ctx.send(embed=create_embed("Ошибка", "Используйте число или 'all'"))
 
-@bot.command()
+@bot.hybrid_command(description="Пропустить текущий трек")
 async def skip(ctx):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
-    if state.voice_client and state.voice_client.is_playing():
-        state.voice_client.stop()
+    if state.player.status in (PlayerStatus.PLAYING, PlayerStatus.PAUSED):
+        state.player.post('skip')
         await ctx.send(embed=create_embed("Пропущено", "⏭️ Песня была пропущена."))
     else:
         await ctx.send(embed=create_embed("Ошибка", "Сейчас ничего не играет."))
 
-@bot.command()
+@bot.hybrid_command(description="Остановить воспроизведение")
 async def stop(ctx):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
     if state.nowplaying_updater:
         state.nowplaying_updater.cancel()
         state.nowplaying_updater = None
 
+    state.queue.clear()
+    state.current = None
+    state.is_radio = False
+    state.is_looping = False
+    state.autoplay = False
+    state.last_playing_message = None
+    state.player.post('stop')
+    mark_queue_dirty(state)
+
+    # Соединение не закрываем сразу, чтобы следующий ?play не ждал подключения
     if state.voice_client:
-        state.voice_client.stop()
-        if state.voice_client.is_connected():
-            await state.voice_client.disconnect()
-        state.voice_client = None
+        voice_manager.release(ctx.guild.id)
+
+    await ctx.send(embed=create_embed(
+        "Остановлено",
+        f"⏹️ Воспроизведение остановлено. Бот выйдет из канала через {VOICE_IDLE_TIMEOUT // 60} мин. или по команде `?leave`."
+    ))
+
+@bot.hybrid_command(description="Выйти из голосового канала")
+async def leave(ctx):
+    state = peek_server_state(ctx.guild.id)
+
+    if not state.voice_client:
+        return await ctx.send(embed=create_embed("Ошибка", "Бот не подключен к голосовому каналу."))
+
+    if state.nowplaying_updater:
+        state.nowplaying_updater.cancel()
+        state.nowplaying_updater = None
 
     state.queue.clear()
     state.current = None
     state.is_radio = False
     state.is_looping = False
-    state.is_paused = False
+    state.autoplay = False
     state.last_playing_message = None
+    state.player.post('stop')
+    mark_queue_dirty(state)
+    await voice_manager.disconnect(ctx.guild.id)
+    await ctx.send(embed=create_embed("Отключено", "👋 Бот вышел из голосового канала."))
 
-    await ctx.send(embed=create_embed("Остановлено", "⏹️ Воспроизведение остановлено и бот отключен."))
-
-@bot.command()
+@bot.hybrid_command(description="Приостановить/возобновить воспроизведение")
 async def pause(ctx):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
     if not state.voice_client or not state.voice_client.is_connected():
         return await ctx.send(embed=create_embed("Ошибка", "Бот не подключен к голосовому каналу."))
-    if state.voice_client.is_playing():
-        state.voice_client.pause()
-        state.is_paused = True
+    if state.player.pause():
+        mark_queue_dirty(state)
         await ctx.send(embed=create_embed("Пауза", "⏸️ Воспроизведение приостановлено."))
-    elif state.voice_client.is_paused():
-        state.voice_client.resume()
-        state.is_paused = False
+    elif state.player.resume():
         await ctx.send(embed=create_embed("Продолжено", "▶️ Воспроизведение возобновлено."))
     else:
         await ctx.send(embed=create_embed("Ошибка", "Сейчас ничего не играет."))
 
-@bot.command()
-async def volume(ctx, level: int = None):
-    state = get_server_state(ctx.guild.id)
-    
+@bot.hybrid_command(description="Установить громкость")
+async def volume(ctx, level: Optional[int] = None):
     if level is None:
+        state = peek_server_state(ctx.guild.id)
         return await ctx.send(embed=create_embed(
             "Громкость",
             f"🔊 Текущая громкость: {int(state.current_volume * 100)}%"
@@ -603,6 +3718,7 @@ async def volume(ctx, level: int = None):
             "Ошибка",
             "Уровень громкости должен быть между 0 и 150"
         ))
+    state = get_server_state(ctx.guild.id)
     state.current_volume = level / 100
     if state.voice_client and state.voice_client.source:
         state.voice_client.source.volume = state.current_volume
@@ -611,18 +3727,20 @@ async def volume(ctx, level: int = None):
         f"🔊 Установлена громкость: {level}%"
     ))
 
-@bot.command()
+@bot.hybrid_command(description="Перемешать очередь")
 async def shuffle(ctx):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
     if not state.queue:
         return await ctx.send(embed=create_embed("Очередь пуста"))
-    random.shuffle(state.queue)
+    state.queue.shuffle()
+    mark_queue_dirty(state)
     await ctx.send(embed=create_embed("Перемешано", "🔀 Очередь перемешана."))
 
-@bot.command()
+@bot.hybrid_command(description="Поиск на YouTube (только текст)")
 async def search(ctx, *, query: str):
     state = get_server_state(ctx.guild.id)
+    await ctx.defer()
     
     if is_valid_url(query):
         return await ctx.send(embed=create_embed(
@@ -640,28 +3758,26 @@ async def search(ctx, *, query: str):
         return await ctx.send(embed=create_embed("Ошибка", "Вы должны находиться в голосовом канале."))
 
     try:
-        if not state.voice_client or not state.voice_client.is_connected():
-            state.voice_client = await ctx.author.voice.channel.connect()
-        elif state.voice_client.channel != ctx.author.voice.channel:
-            await state.voice_client.move_to(ctx.author.voice.channel)
+        await voice_manager.ensure_connected(ctx)
     except Exception as e:
         return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
 
     try:
-        results = await run_in_executor(
-            lambda: YTDL.extract_info(f"ytsearch4:{query}", download=False)['entries']
-        )
+        results = await search_flat_async(query, 4)
     except Exception as e:
         return await ctx.send(embed=create_embed("Ошибка", f"Не удалось выполнить поиск: {e}"))
 
     valid_results = []
     for entry in results:
         if entry and entry.get('url'):
-            valid_results.append(entry)
+            valid_results.append(process_flat_entry(entry))
 
     if not valid_results:
         return await ctx.send(embed=create_embed("Ошибка", "Ничего не найдено."))
 
+    # Пока пользователь выбирает, заранее получаем поток первого результата
+    prefetch_track(valid_results[0], query)
+
     lines = []
     for i, entry in enumerate(valid_results, 1):
         duration = format_duration(entry.get('duration', 0))
@@ -691,36 +3807,34 @@ async def search(ctx, *, query: str):
 
         index = reactions.index(str(reaction.emoji))
         if index < len(valid_results):
-            entry = valid_results[index]
-            url = entry['url']
-            title = entry['title']
-            duration = entry.get('duration', 0)
-
-            state.queue.append({
-                'url': url,
-                'title': title,
-                'duration': duration,
-                'user': ctx.author
-            })
+            track = valid_results[index]
+            title = track['title']
+            duration = track['duration']
+
+            # Трек добавляется сразу, поток будет получен перед воспроизведением
+            if index != 0:
+                prefetch_track(track)
+            track['user'] = ctx.author
+            state.queue.append(track)
+            mark_queue_dirty(state)
 
             await ctx.send(embed=create_embed(
                 "Добавлено в очередь",
                 f"✅ **{title}** (`{format_duration(duration)}`)\nДобавил: {ctx.author.mention}"
             ))
 
-            if not state.voice_client.is_playing() and not state.is_paused:
-                await play_next(ctx)
+            state.player.post('play', ctx)
 
             await message.delete()
     except asyncio.TimeoutError:
         await message.delete()
         await ctx.send(embed=create_embed("Время вышло", "Выбор трека отменен."))
 
-@bot.command()
+@bot.hybrid_command(description="Перемотка вперед/назад в секундах")
 async def seek(ctx, seconds_str: str):
-    state = get_server_state(ctx.guild.id)
+    state = peek_server_state(ctx.guild.id)
     
-    if not state.current or not state.voice_client or not state.voice_client.is_playing():
+    if not state.current or state.player.status is not PlayerStatus.PLAYING:
         return await ctx.send(embed=create_embed("Ошибка", "Ничего не играет."))
     if not seconds_str.startswith(('+', '-')):
         return await ctx.send(embed=create_embed("Ошибка", "Используйте формат: `?seek +30` или `?seek -15`"))
@@ -729,30 +3843,15 @@ async def seek(ctx, seconds_str: str):
     except ValueError:
         return await ctx.send(embed=create_embed("Ошибка", "Введите целое число секунд"))
 
-    current_position = time.time() - state.start_time
-    new_position = max(0, current_position + seconds)
+    current_position = state.player.position()
+    new_position = int(max(0, current_position + seconds))
     duration = state.current.get('duration', 0)
     if new_position > duration:
         return await ctx.send(embed=create_embed("Ошибка", "Время превышает длительность трека."))
 
-    state.start_time = time.time() - new_position
-    state.is_seeking = True
     try:
-        state.voice_client.stop()
-        url = state.current['url']
-        seek_options = {
-            'before_options': f'-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -ss {new_position}',
-            'options': '-vn'
-        }
-        source = discord.FFmpegPCMAudio(url, **seek_options)
-        source = discord.PCMVolumeTransformer(source, volume=state.current_volume)
-
-        def after_seek(e):
-            state.is_seeking = False
-            fut = play_next(ctx)
-            asyncio.run_coroutine_threadsafe(fut, bot.loop)
-
-        state.voice_client.play(source, after=after_seek)
+        state.player.post('seek', new_position)
+        mark_queue_dirty(state)
         await ctx.send(embed=create_embed("Перемотка", f"⏩ Установлена позиция: {format_duration(new_position)}"))
         if state.last_playing_message:
             try:
@@ -761,37 +3860,155 @@ async def seek(ctx, seconds_str: str):
                     f"🎵 **{state.current['title']}**\n"
                     f"{progress_bar}\n"
                     f"`{format_duration(new_position)} / {format_duration(duration)}`\n"
-                    f"Добавил: {state.current['user'].mention}"
+                    f"Добавил: {requester_mention(state.current)}"
                 )
                 await state.last_playing_message.edit(embed=create_embed("Сейчас играет", description))
             except:
                 pass
     except Exception as e:
-        state.is_seeking = False
         await ctx.send(embed=create_embed("Ошибка", f"Не удалось перемотать: {e}"))
 
-@bot.command()
+@bot.hybrid_command(description="Продолжить сохраненную очередь")
+async def resume(ctx):
+    state = peek_server_state(ctx.guild.id)
+    await ctx.defer()
+
+    if not state.queue:
+        return await ctx.send(embed=create_embed("Очередь пуста"))
+    if state.player.status is not PlayerStatus.IDLE:
+        return await ctx.send(embed=create_embed("Ошибка", "Очередь уже воспроизводится."))
+    if not ctx.author.voice:
+        return await ctx.send(embed=create_embed("Ошибка", "Вы должны находиться в голосовом канале."))
+
+    try:
+        await voice_manager.ensure_connected(ctx)
+    except Exception as e:
+        return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
+
+    await ctx.send(embed=create_embed(
+        "Очередь восстановлена",
+        f"▶️ Треков в очереди: {len(state.queue)}, `{format_duration(state.queue.total_duration)}`"
+    ))
+    state.player.post('play', ctx)
+
+@bot.hybrid_command(description="Сохранить текущую очередь как плейлист сервера")
+async def save(ctx, *, name: str):
+    state = peek_server_state(ctx.guild.id)
+    name = ' '.join(name.split())
+
+    if not name or len(name) > SAVED_PLAYLIST_NAME_MAX:
+        return await ctx.send(embed=create_embed(
+            "Ошибка", f"Название плейлиста должно быть от 1 до {SAVED_PLAYLIST_NAME_MAX} символов."
+        ))
+
+    records = []
+    for track in ([state.current] if state.current and not state.is_radio else []) + list(state.queue):
+        if track.get('webpage_url'):
+            record = track_record(track)
+            record.pop('user_id', None)
+            records.append(record)
+    if not records:
+        return await ctx.send(embed=create_embed("Ошибка", "Очередь пуста, сохранять нечего."))
+    records = records[:SAVED_PLAYLIST_MAX_TRACKS]
+
+    try:
+        saved = await run_in_executor(save_playlist_sync, ctx.guild.id, name, ctx.author.id, records)
+    except (OSError, ValueError) as e:
+        return await ctx.send(embed=create_embed("Ошибка", f"Не удалось сохранить плейлист: {e}"))
+    if not saved:
+        return await ctx.send(embed=create_embed(
+            "Ошибка", f"На сервере уже {SAVED_PLAYLISTS_MAX} плейлистов. Перезапишите один из них."
+        ))
+
+    duration = sum(record.get('duration') or 0 for record in records)
+    await ctx.send(embed=create_embed(
+        "Плейлист сохранен",
+        f"💾 **{name}**: {len(records)} треков, `{format_duration(duration)}`\nЗагрузить: `?load {name}`"
+    ))
+
+@bot.hybrid_command(description="Загрузить сохраненный плейлист сервера")
+async def load(ctx, *, name: str):
+    state = get_server_state(ctx.guild.id)
+    await ctx.defer()
+
+    if state.is_radio:
+        return await ctx.send(embed=create_embed(
+            "Ошибка",
+            "Сейчас играет радио. Остановите радио командой `?stop`, чтобы добавить треки в очередь."
+        ))
+    if not ctx.author.voice:
+        return await ctx.send(embed=create_embed("Ошибка", "Вы должны находиться в голосовом канале."))
+
+    try:
+        playlists = await run_in_executor(read_saved_playlists, ctx.guild.id)
+    except (OSError, ValueError) as e:
+        return await ctx.send(embed=create_embed("Ошибка", f"Не удалось прочитать плейлисты: {e}"))
+    saved = playlists.get(' '.join(name.split()).lower())
+    if not saved:
+        return await ctx.send(embed=create_embed("Ошибка", f"Плейлист **{name}** не найден. Список: `?playlists`"))
+
+    try:
+        await voice_manager.ensure_connected(ctx)
+    except Exception as e:
+        return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
+
+    # Треки ставятся в очередь сразу, ссылки на потоки получаются перед воспроизведением
+    tracks = []
+    for record in saved['tracks']:
+        track = track_from_record(record)
+        track['user'] = ctx.author
+        tracks.append(track)
+    state.queue.extend(tracks)
+    mark_queue_dirty(state)
+
+    await ctx.send(embed=create_embed(
+        "Плейлист загружен",
+        f"✅ **{saved['name']}**: добавлено треков: {len(tracks)}, `{format_duration(saved['duration'])}`\n"
+        f"Добавил: {ctx.author.mention}"
+    ))
+    state.player.post('play', ctx)
+
+@bot.hybrid_command(description="Плейлисты")
 async def playlists(ctx):
-    await ctx.send(embed=create_embed("Плейлисты", "🎧 Вставьте ссылку на YouTube-плейлист в команду ?playlist."))
+    try:
+        saved = await run_in_executor(read_saved_playlists, ctx.guild.id)
+    except (OSError, ValueError) as e:
+        print(f"Ошибка чтения плейлистов: {e}")
+        saved = {}
+
+    lines = [
+        f"💾 **{playlist['name']}** — {len(playlist['tracks'])} треков, `{format_duration(playlist['duration'])}`"
+        for playlist in sorted(saved.values(), key=lambda playlist: playlist['name'].lower())
+    ]
+    if not lines:
+        lines.append("На сервере пока нет сохраненных плейлистов. Сохранить очередь: `?save <название>`")
+    lines.append("\n🎧 Вставьте ссылку на YouTube-плейлист в команду ?playlist.")
+    await ctx.send(embed=create_embed("Плейлисты", "\n".join(lines)))
 
-@bot.command()
+@bot.hybrid_command(description="Показать список команд")
 async def help(ctx):
     embed = create_embed("Список команд", color=0x7B68EE)
     commands_list = [
         ("?pause", "Приостановить/возобновить воспроизведение"),
         ("?nowplaying", "Показать текущий трек с прогресс-баром"),
-        ("?play <название|URL>", "Воспроизвести трек"),
+        ("?play <название|URL>", "Воспроизвести трек; несколько — через ; или с новой строки"),
         ("?playlist <URL>", "Воспроизвести плейлист"),
         ("?queue [страница]", "Показать очередь воспроизведения"),
+        ("?resume", "Продолжить сохраненную очередь"),
+        ("?save <название>", "Сохранить очередь как плейлист сервера"),
+        ("?load <название>", "Загрузить сохраненный плейлист"),
+        ("?playlists", "Сохраненные плейлисты сервера"),
         ("?remove <позиция|all>", "Удалить трек из очереди"),
         ("?search <запрос>", "Поиск на YouTube (только текст)"),
         ("?seek <+/-секунды>", "Перемотка вперед/назад в секундах"),
         ("?shuffle", "Перемешать очередь"),
         ("?skip", "Пропустить текущий трек"),
-        ("?stop", "Остановить воспроизведение и выйти"),
+        ("?stop", "Остановить воспроизведение"),
+        ("?leave", "Выйти из голосового канала"),
         ("?volume [0-150]", "Установить громкость"),
         ("?ping", "Проверить задержку бота"),
         ("?loop", "Включить/выключить повтор трека"),
+        ("?autoplay", "Играть похожие треки, когда очередь закончится"),
         ("?radio <URL>", "Воспроизвести радио-поток"),
         ("?help", "Показать это сообщение"),
         ("?about", "Информация о боте")
@@ -800,47 +4017,156 @@ async def help(ctx):
         embed.add_field(name=cmd, value=desc, inline=False)
     await ctx.send(embed=embed)
 
-@bot.command()
+@bot.hybrid_command(description="Воспроизвести радио-поток")
 async def radio(ctx, url: str):
     state = get_server_state(ctx.guild.id)
-    
-    if state.voice_client and (state.voice_client.is_playing() or state.voice_client.is_paused()):
-        state.voice_client.stop()
+    await ctx.defer()
+
+    if not url.startswith(('http://', 'https://')):
+        return await ctx.send(embed=create_embed("Ошибка", "Нужна ссылка на поток (http:// или https://)."))
+    error = await http_pool.check_radio(url)
+    if error:
+        return await ctx.send(embed=create_embed("Ошибка", f"Не удалось воспроизвести радио: {error}"))
+
     state.queue.clear()
     state.current = None
     state.last_playing_message = None
     state.is_radio = True
-    state.is_paused = False
+    mark_queue_dirty(state)
     state.is_looping = False
     try:
         if not ctx.author.voice:
             return await ctx.send(embed=create_embed("Ошибка", "Вы должны находиться в голосовом канале."))
-        if not state.voice_client or not state.voice_client.is_connected():
-            state.voice_client = await ctx.author.voice.channel.connect()
-        elif state.voice_client.channel != ctx.author.voice.channel:
-            await state.voice_client.move_to(ctx.author.voice.channel)
+        await voice_manager.ensure_connected(ctx)
     except Exception as e:
         return await ctx.send(embed=create_embed("Ошибка подключения", f"{e}"))
 
-    def after_playing(e):
-        fut = play_next(ctx)
-        asyncio.run_coroutine_threadsafe(fut, bot.loop)
+    state.player.post('radio', ctx, url)
 
-    try:
-        source = discord.FFmpegPCMAudio(url, **ffmpeg_options)
-        source = discord.PCMVolumeTransformer(source, state.current_volume)
-        if state.voice_client:
-            state.voice_client.play(source, after=after_playing)
-            await ctx.send(embed=create_embed("Радио", f"📻 {url}"))
-    except Exception as e:
-        await ctx.send(embed=create_embed("Ошибка", f"Не удалось воспроизвести радио: {e}"))
+@bot.hybrid_command(description="Включить/выключить автовоспроизведение похожих треков")
+async def autoplay(ctx):
+    state = get_server_state(ctx.guild.id)
+
+    state.autoplay = not state.autoplay
+    if state.autoplay:
+        # Если очередь уже пуста, следующий трек подбирается сразу
+        state.player.prefetch_autoplay()
+    await ctx.send(embed=create_embed(
+        "Автовоспроизведение",
+        "📻 Когда очередь закончится, будут играть похожие треки" if state.autoplay else "📻 Автовоспроизведение выключено"
+    ))
 
-@bot.command()
+@bot.hybrid_command(description="Включить/выключить повтор трека")
 async def loop(ctx):
     state = get_server_state(ctx.guild.id)
     
     state.is_looping = not state.is_looping
+    state.player.queue_changed()
     await ctx.send(embed=create_embed("Повтор", f"🔁 {'Повтор включён' if state.is_looping else 'Повтор выключен'}"))
 
-# Замените на ваш токен
-bot.run('')
\ No newline at end of file
+# Служебные команды для владельца бота
+@bot.group(name='admin', invoke_without_command=True)
+@commands.is_owner()
+async def admin(ctx):
+    await ctx.send(embed=create_embed("Администрирование", "Подкоманды: `sync`, `voice`, `memory`, `ffmpeg`, `nodes`, `library`, `history`, `loudness`, `http`, `startup`, `lag`, `load`"))
+
+@admin.command(name='sync')
+async def admin_sync(ctx):
+    """Регистрация слеш-команд в Discord (нужна после изменения списка команд)"""
+    synced = await bot.tree.sync()
+    await ctx.send(embed=create_embed("Слеш-команды", f"Синхронизировано команд: {len(synced)}"))
+
+@admin.command(name='voice')
+async def admin_voice(ctx):
+    await ctx.send(embed=create_embed("Голосовые соединения", f"{voice_manager.report()}\n{encoder_report()}\n{mixer_report()}"))
+
+@admin.command(name='ffmpeg')
+async def admin_ffmpeg(ctx):
+    report = await run_in_executor(ffmpeg_registry.report)
+    await ctx.send(embed=create_embed("Процессы ffmpeg", report))
+
+@admin.command(name='nodes')
+async def admin_nodes(ctx):
+    report = await run_in_executor(node_pool.report)
+    await ctx.send(embed=create_embed("Аудиоузлы", report))
+
+@admin.command(name='library')
+async def admin_library(ctx):
+    if library is None:
+        return await ctx.send(embed=create_embed("Библиотека", "Локальная библиотека не настроена (`LOCAL_LIBRARY_DIR`)."))
+    await ctx.send(embed=create_embed("Библиотека", library.report()))
+
+@admin.command(name='history')
+async def admin_history(ctx):
+    await ctx.send(embed=create_embed("История воспроизведения", f"{play_history.report()}\n{cache_warmer.report()}"))
+
+@admin.command(name='loudness')
+async def admin_loudness(ctx):
+    status = f"цель {LOUDNESS_TARGET:g} LUFS" if LOUDNESS_NORMALIZE else "выключена"
+    await ctx.send(embed=create_embed("Нормализация громкости", f"Нормализация: {status}\n{loudness.report()}"))
+
+@admin.command(name='http')
+async def admin_http(ctx):
+    await ctx.send(embed=create_embed("HTTP", http_pool.report()))
+
+@admin.command(name='startup')
+async def admin_startup(ctx):
+    status = "загружен" if youtube_dl is not None else "загружается"
+    await ctx.send(embed=create_embed(
+        "Запуск",
+        f"Режим `{STARTUP_MODE}`: {format_startup_timings() or 'нет данных'}\nyt-dlp {status}"
+    ))
+
+@admin.command(name='lag')
+async def admin_lag(ctx):
+    await ctx.send(embed=create_embed("Задержка цикла событий", loop_monitor.report()))
+
+@admin.command(name='load')
+async def admin_load(ctx):
+    await ctx.send(embed=create_embed("Перегрузка", overload.report()))
+
+@admin.command(name='memory')
+async def admin_memory(ctx):
+    now = time.monotonic()
+    rows = sorted(
+        ((estimate_state_bytes(state), guild_id, state) for guild_id, state in server_states.items()),
+        key=lambda row: row[0], reverse=True
+    )
+    total = sum(row[0] for row in rows)
+    lines = [
+        f"Состояний: {len(rows)} из {len(bot.guilds)} серверов | всего ~{total / 1024:.1f} КБ | "
+        f"кэш поиска: {len(search_cache)}, треков: {len(track_cache)}, плейлистов: {len(playlist_cache)} "
+        f"({', '.join(f'{name}: {count}' for name, count in playlist_cache_stats.items())})"
+    ]
+    for size, guild_id, state in rows[:15]:
+        guild = bot.get_guild(guild_id)
+        name = guild.name if guild else guild_id
+        status = "активен" if not state.is_idle() else f"простой {int(now - state.last_active)}с"
+        lines.append(f"**{name}**: {len(state.queue)} треков, ~{size / 1024:.1f} КБ, {status}")
+
+    # Для сравнения профилей намерений: кэш участников и RSS процесса
+    members = sum(len(guild.members) for guild in bot.guilds)
+    largest = max(bot.guilds, key=lambda guild: guild.member_count or 0, default=None)
+    usage = process_usage(os.getpid())
+    lines.append(
+        f"Профиль `{INTENTS_PROFILE}`: в кэше {members} участников и {len(bot.users)} пользователей"
+        + (f", крупнейший сервер {largest.member_count} участников ({len(largest.members)} в кэше)" if largest else "")
+        + (f", RSS {usage[1] / 1048576:.1f} МБ" if usage else "")
+    )
+    await ctx.send(embed=create_embed("Память", "\n".join(lines)))
+
+def install_event_loop():
+    if EVENT_LOOP != 'uvloop':
+        return
+    try:
+        import uvloop
+    except ImportError:
+        print("uvloop не установлен, используется стандартный цикл событий")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# Процессы пула сканирования библиотеки не должны запускать бота
+if __name__ == '__main__':
+    install_event_loop()
+    # Замените на ваш токен
+    bot.run('')
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""Аудиоузел Кассеты: отдельный процесс, который запускает ffmpeg, применяет громкость,
+кодирует звук в Opus и передает боту готовые кадры по локальному сокету.
+
+Запуск: python audio_node.py [порт]
+
+Протокол (одно TCP-соединение на один поток):
+- бот отправляет JSON-строку {"op": "play", "url", "position", "volume", "bitrate",
+  "complexity", "before_options", "options"}, а затем, пока поток играет, строки
+  {"op": "volume", "value"}, {"op": "encoder", "bitrate", "complexity"} и {"op": "stop"};
+- узел отвечает пакетами: 1 байт типа, 4 байта длины, данные. Тип a — кадр Opus,
+  тип e — JSON-событие: position (позиция в секундах), end (поток закончился),
+  error (ffmpeg не запустился или упал).
+- {"op": "stats"} вместо play возвращает одно событие stats с числом потоков и pid узла.
+"""
+
+import json
+import os
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import discord
+
+DEFAULT_PORT = 8765
+# На сколько секунд узел может опережать реальное время: запас на случай задержек сети и процессора
+NODE_LEAD = 1.0
+# Как часто сообщать боту позицию (в кадрах по 20 мс)
+POSITION_EVERY = 250
+OPUS_SET_COMPLEXITY_CTL = 4010
+
+HEADER = struct.Struct('!cI')
+
+streams_lock = threading.Lock()
+active_streams = 0
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.send_lock = threading.Lock()
+        self.stopped = False
+        self.volume = 1.0
+        self.encoder_settings = None
+
+    def send(self, kind, payload):
+        with self.send_lock:
+            self.wfile.write(HEADER.pack(kind, len(payload)) + payload)
+            self.wfile.flush()
+
+    def send_event(self, event, **data):
+        self.send(b'e', json.dumps(dict(data, event=event)).encode())
+
+    def handle(self):
+        global active_streams
+        line = self.rfile.readline()
+        if not line:
+            return
+        request = json.loads(line)
+
+        if request['op'] == 'stats':
+            return self.send_event('stats', streams=active_streams, pid=os.getpid())
+        if request['op'] != 'play':
+            return self.send_event('error', message=f"Неизвестная операция: {request['op']}")
+
+        with streams_lock:
+            active_streams += 1
+        try:
+            threading.Thread(target=self.read_commands, daemon=True).start()
+            self.stream(request)
+        except (BrokenPipeError, ConnectionResetError):
+            # Бот закрыл соединение: трек пропущен или бот перезапускается
+            pass
+        finally:
+            with streams_lock:
+                active_streams -= 1
+
+    def read_commands(self):
+        """Команды бота во время воспроизведения; закрытое соединение означает остановку"""
+        try:
+            for line in self.rfile:
+                command = json.loads(line)
+                if command['op'] == 'volume':
+                    self.volume = max(0.0, float(command['value']))
+                elif command['op'] == 'encoder':
+                    self.encoder_settings = (command['bitrate'], command['complexity'])
+                elif command['op'] == 'stop':
+                    break
+        except (OSError, ValueError):
+            pass
+        self.stopped = True
+
+    def stream(self, request):
+        before_options = request.get('before_options', '')
+        if request.get('position'):
+            before_options = f"{before_options} -ss {request['position']}"
+
+        try:
+            encoder = discord.opus.Encoder(bitrate=request.get('bitrate', 128))
+            source = discord.FFmpegPCMAudio(request['url'], before_options=before_options, options=request.get('options'))
+        except Exception as e:
+            return self.send_event('error', message=str(e))
+
+        self.volume = request.get('volume', 1.0)
+        source = discord.PCMVolumeTransformer(source, volume=self.volume)
+        self.encoder_settings = (request.get('bitrate', 128), request.get('complexity', 10))
+
+        started = time.perf_counter()
+        frames = 0
+        try:
+            while not self.stopped:
+                # Настройки меняются в потоке команд, а применяются здесь, между кадрами
+                if self.encoder_settings is not None:
+                    bitrate, complexity = self.encoder_settings
+                    self.encoder_settings = None
+                    encoder.set_bitrate(bitrate)
+                    discord.opus._lib.opus_encoder_ctl(encoder._state, OPUS_SET_COMPLEXITY_CTL, complexity)
+                source.volume = self.volume
+
+                pcm = source.read()
+                if not pcm:
+                    break
+                self.send(b'a', encoder.encode(pcm, encoder.SAMPLES_PER_FRAME))
+                frames += 1
+
+                if frames % POSITION_EVERY == 0:
+                    self.send_event('position', seconds=request.get('position', 0) + frames * 0.02)
+
+                ahead = frames * 0.02 - (time.perf_counter() - started)
+                if ahead > NODE_LEAD:
+                    time.sleep(ahead - NODE_LEAD)
+
+            if not self.stopped:
+                error = getattr(source.original, '_current_error', None)
+                if error:
+                    self.send_event('error', message=str(error))
+                else:
+                    self.send_event('end')
+        finally:
+            source.cleanup()
+
+class NodeServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PORT
+    server = NodeServer(('127.0.0.1', port), StreamHandler)
+    print(f"Аудиоузел слушает 127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()